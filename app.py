@@ -22,6 +22,7 @@ from config import SAVE_RAG_FILES
 from config import USE_LOCAL_RAG_FILES
 
 from transaction_analyzer import TransactionAnalyzer
+from llm_clients import make_async_client
 from document_analyzer import DocumentAnalyzer
 from regulatory_consultant import RegulatoryConsultant
 from document_utils import batch_extract_text
@@ -44,10 +45,12 @@ GENERATION_MODEL = "google/gemini-2.5-flash-lite"
 
 # === ИНИЦИАЛИЗАЦИЯ КЛИЕНТА ===
 open_router_client = OpenAI(base_url=BASE_URL, api_key=OPEN_ROUTER_API_KEY)
+# Асинхронный клиент с общим пулом HTTP/2-соединений для категоризации транзакций
+async_open_router_client = make_async_client()
 
 # === ИНИЦИАЛИЗАЦИЯ СЕРВИСОВ ===
 transaction_analyzer = TransactionAnalyzer(
-    open_router_client,
+    async_open_router_client,
     GENERATION_MODEL
 )
 
@@ -411,24 +414,17 @@ async def get_period_comparison(
             previous_end_dt = datetime.fromisoformat(previous_end)
             
             # Получаем транзакции за оба периода
-            all_transactions = transaction_history.get_historical_transactions(days_back=365)
+            dated_transactions = transaction_history.get_dated_transactions(days_back=365)
             
             current_tx = []
             previous_tx = []
             
-            for tx in all_transactions:
-                try:
-                    date_str = tx.get("Дата", "")
-                    if not date_str:
-                        continue
-                    if isinstance(date_str, str):
-                        tx_date = datetime.fromisoformat(date_str.split('T')[0])
-                        if current_start_dt <= tx_date <= current_end_dt:
-                            current_tx.append(tx)
-                        elif previous_start_dt <= tx_date <= previous_end_dt:
-                            previous_tx.append(tx)
-                except (ValueError, AttributeError):
-                    continue
+            # Дата уже разобрана при чтении истории, транзакции без даты пропущены
+            for tx_date, tx in dated_transactions:
+                if current_start_dt <= tx_date <= current_end_dt:
+                    current_tx.append(tx)
+                elif previous_start_dt <= tx_date <= previous_end_dt:
+                    previous_tx.append(tx)
             
             # Используем существующую функцию агрегации
             def aggregate_period(transactions):
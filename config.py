@@ -13,11 +13,17 @@ BASE_URL = "https://openrouter.ai/api/v1"
 
 LOGGING_TOKEN_USAGE = True  # Логгировать использование токенов
 LOGGING_TIME_USAGE = True  # Логгировать использование времени
+LOGGING_ANALYSIS_DEBUG = False  # Печатать отладочные сообщения анализа транзакций ([DEBUG], [FORECAST])
 
 # Файлы для артефактов
 REGULATORY_CONSULTANT_FAISS_INDEX_PATH = "artefacts/regulatory_consultant_faiss_index.bin"
 REGULATORY_CONSULTANT_CHUNKS_PATH = "artefacts/corpus_chunks.pkl"
 RAW_DOCUMENTS_PATH = "knowledge_base_builder/output/raw_documents.jsonl"
+LLM_CACHE_PATH = "artefacts/llm_cache.sqlite"
+
+# Кэширование ответов LLM при категоризации транзакций
+USE_LLM_CACHE = True
+LLM_CACHE_MEMORY_SIZE = 10_000  # Количество записей в in-memory LRU перед SQLite
 
 # Использование локальных файлов RAG
 USE_LOCAL_RAG_FILES = True
@@ -26,9 +32,16 @@ SAVE_RAG_FILES = True
 # Параметры для TransactionAnalyzer
 TRANSACTION_ANALYZER_CONFIG = {
     "batch_size": 20,  # Количество транзакций в одном батче
+    "max_concurrent_requests": 8,  # Максимальное количество одновременных LLM-запросов (батчей)
+    "max_requests_per_minute": 120,  # Лимит LLM-запросов в минуту (скользящее окно), 0 — без ограничения
+    "use_rule_based_categorization": True,  # Категоризировать очевидные транзакции правилами без LLM
+    "use_prompt_cache_control": True,  # Помечать системный промпт для кэширования префикса у провайдера
     "max_retries": 3,  # Максимальное количество попыток при ошибке API
-    "retry_delay": 1.0,  # Задержка между попытками (секунды)
+    "retry_delay": 1.0,  # Базовая задержка между попытками (секунды), растет экспоненциально
+    "retry_max_delay": 30.0,  # Максимальная задержка между попытками (секунды)
     "timeout": 30.0,  # Таймаут для LLM запроса (секунды)
+    "http_max_keepalive_connections": 32,  # Размер пула keep-alive соединений асинхронного клиента
+    "http_max_connections": 64,  # Максимальное количество соединений асинхронного клиента
     "new_counterparty_threshold": 10000,  # Порог суммы для уведомления о новом контрагенте
     "outlier_sigma_threshold": 2.5,  # Порог для определения outliers (стандартные отклонения) - снижен для более чувствительного обнаружения
     "cac_warning_threshold": 0.3,  # Порог для предупреждения о высоком CAC
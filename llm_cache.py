@@ -0,0 +1,129 @@
+"""
+Персистентный кэш ответов LLM для категоризации транзакций.
+Запросы выполняются с temperature=0.0, поэтому одинаковый текст назначения платежа
+даёт одинаковый результат, и повторный запрос к модели не нужен.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from config import LLM_CACHE_PATH, USE_LLM_CACHE, LLM_CACHE_MEMORY_SIZE
+
+
+# Цифры остаются в ключе: в кэше хранится и контрагент, а «ИП Иванов 1» и «ИП Иванов 2» — разные контрагенты
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+
+class LLMCache:
+    """Кэш результатов категоризации по нормализованному тексту: in-memory LRU поверх SQLite."""
+
+    def __init__(self, cache_path: str = LLM_CACHE_PATH, enabled: bool = USE_LLM_CACHE,
+                 memory_size: int = LLM_CACHE_MEMORY_SIZE):
+        self.cache_path = cache_path
+        self.enabled = enabled
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Лениво открывает соединение и создает таблицу кэша."""
+        if self._conn is None:
+            cache_dir = os.path.dirname(self.cache_path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+        return self._conn
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        Нормализует текст: нижний регистр, ё -> е,
+        пунктуация удаляется, пробелы схлопываются.
+        """
+        text = str(text).casefold().replace("ё", "е")
+        text = _PUNCTUATION_RE.sub(" ", text)
+        return " ".join(text.split())
+
+    @classmethod
+    def make_key(cls, model: str, text: str, direction: int = 0) -> str:
+        """
+        Строит ключ кэша по модели, направлению платежа (1 — поступление, -1 — списание,
+        0 — неизвестно) и нормализованному тексту: один текст у поступления и у списания
+        может означать разные категории.
+        """
+        payload = f"{model}\x00{direction}\x00{cls.normalize(text)}"
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _remember(self, key: str, value: str) -> None:
+        """Кладет значение в in-memory LRU, вытесняя самые давние записи. Вызывается под блокировкой."""
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model: str, texts: List[str], directions: Optional[List[int]] = None) -> List[Optional[Dict]]:
+        """
+        Возвращает закэшированные результаты для списка текстов (с направлениями платежей, если заданы).
+        Для отсутствующих в кэше текстов возвращается None.
+        """
+        if not self.enabled or not texts:
+            return [None] * len(texts)
+
+        if directions is None:
+            directions = [0] * len(texts)
+        keys = [self.make_key(model, text, direction) for text, direction in zip(texts, directions)]
+        found = {}
+        with self._lock:
+            # Сначала смотрим в памяти, в SQLite идем только за недостающими ключами
+            unique_keys = []
+            for key in dict.fromkeys(keys):
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                else:
+                    unique_keys.append(key)
+            if unique_keys:
+                conn = self._get_connection()
+            # SQLite ограничивает количество параметров в запросе
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT key, value FROM llm_cache WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, value in rows:
+                    found[key] = value
+                    self._remember(key, value)
+
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def set_many(self, model: str, texts: List[str], values: List[Dict],
+                 directions: Optional[List[int]] = None) -> None:
+        """Сохраняет результаты категоризации для списка текстов (с направлениями платежей, если заданы)."""
+        if not self.enabled or not texts:
+            return
+        if directions is None:
+            directions = [0] * len(texts)
+        rows = [
+            (self.make_key(model, text, direction), json.dumps(value, ensure_ascii=False))
+            for text, value, direction in zip(texts, values, directions)
+        ]
+        with self._lock:
+            conn = self._get_connection()
+            conn.executemany("INSERT OR REPLACE INTO llm_cache (key, value) VALUES (?, ?)", rows)
+            conn.commit()
+            for key, value in rows:
+                self._remember(key, value)
+
+
+# Глобальный экземпляр
+llm_cache = LLMCache()
@@ -0,0 +1,29 @@
+"""
+Фабрика клиентов OpenAI-совместимого API (OpenRouter) для точек входа приложения.
+Настройки пула соединений задаются в одном месте и не расходятся между main.py и app.py.
+"""
+import httpx
+from openai import AsyncOpenAI
+
+from config import BASE_URL, OPEN_ROUTER_API_KEY, TRANSACTION_ANALYZER_CONFIG
+
+
+def make_async_client() -> AsyncOpenAI:
+    """
+    Асинхронный клиент для параллельной категоризации транзакций: общий пул HTTP/2-соединений
+    позволяет мультиплексировать параллельные запросы без повторных TLS-рукопожатий.
+    Повторы выполняет сам TransactionAnalyzer, поэтому встроенные повторы клиента отключены.
+    """
+    return AsyncOpenAI(
+        base_url=BASE_URL,
+        api_key=OPEN_ROUTER_API_KEY,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=TRANSACTION_ANALYZER_CONFIG["http_max_keepalive_connections"],
+                max_connections=TRANSACTION_ANALYZER_CONFIG["http_max_connections"],
+            ),
+        ),
+        timeout=TRANSACTION_ANALYZER_CONFIG["timeout"],
+        max_retries=0,
+    )
@@ -13,6 +13,7 @@ from config import USE_LOCAL_RAG_FILES
 from document_analyzer import DocumentAnalyzer
 from regulatory_consultant import RegulatoryConsultant
 from transaction_analyzer import TransactionAnalyzer
+from llm_clients import make_async_client
 from time_logger import timed, time_logger
 from token_logger import token_logger
 
@@ -24,6 +25,8 @@ GENERATION_MODEL = "google/gemini-2.5-flash-lite"
 
 # Инициализация клиентов для OpenAI API
 open_router_client = OpenAI(base_url=BASE_URL, api_key=OPEN_ROUTER_API_KEY)
+# Асинхронный клиент с общим пулом HTTP/2-соединений для категоризации транзакций
+async_open_router_client = make_async_client()
 
 @timed
 def choose_tool(user_prompt: str, documents: Optional[List[Dict[str, str]]]) -> Dict[str, str]:
@@ -69,7 +72,7 @@ def choose_tool(user_prompt: str, documents: Optional[List[Dict[str, str]]]) ->
     return chosen_tool
 
 # Инициализация базовых инструментов
-transaction_analyzer = TransactionAnalyzer(open_router_client,
+transaction_analyzer = TransactionAnalyzer(async_open_router_client,
                                            GENERATION_MODEL
                                            )
 
@@ -0,0 +1,54 @@
+"""
+Агрегаты по категориям через np.bincount по кодам pd.Categorical должны совпадать
+с исходным groupby: сумма, сумма модулей, количество и порядок первого появления категорий.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from transaction_analyzer import TransactionAnalyzer
+
+
+def baseline_aggregate(df: pd.DataFrame) -> pd.DataFrame:
+    """Исходная реализация _aggregate_by_category на groupby."""
+    grouped = df[["Сумма", "_abs_sum"]].set_axis(["sum", "abs_sum"], axis=1).groupby(
+        df["Категория"], sort=False, observed=True
+    )
+    category_totals = grouped.sum()
+    category_totals["count"] = grouped.size()
+    return category_totals
+
+
+def make_frame(n: int, seed: int, with_missing: bool) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    names = np.array(["Аренда", "Зарплата", "Поступление от клиента", "Реклама", "Закупка товара"])
+    categories = names[rng.integers(0, len(names), n)].astype(object)
+    if with_missing:
+        categories[rng.random(n) < 0.1] = None
+    amounts = rng.normal(0, 50_000, n).round(2)
+    # Категория «Налоги» объявлена, но не встречается: в агрегатах ее быть не должно
+    return pd.DataFrame({
+        "Категория": pd.Categorical(categories, categories=list(names) + ["Налоги"]),
+        "Сумма": amounts,
+        "_abs_sum": np.abs(amounts),
+    })
+
+
+@pytest.mark.parametrize("with_missing", [False, True], ids=["complete", "with_missing"])
+def test_aggregate_by_category_matches_groupby(with_missing):
+    df = make_frame(5_000, seed=7, with_missing=with_missing)
+    result = TransactionAnalyzer._aggregate_by_category(df)
+    expected = baseline_aggregate(df)
+    assert result.index.tolist() == expected.index.tolist()
+    np.testing.assert_allclose(result["sum"], expected["sum"], rtol=1e-12)
+    np.testing.assert_allclose(result["abs_sum"], expected["abs_sum"], rtol=1e-12)
+    assert result["count"].tolist() == expected["count"].tolist()
+
+
+def test_income_and_expenses_from_aggregates():
+    df = make_frame(1_000, seed=3, with_missing=True)
+    income, expenses = TransactionAnalyzer._income_and_expenses(TransactionAnalyzer._aggregate_by_category(df))
+    is_income = df["Категория"] == "Поступление от клиента"
+    has_category = df["Категория"].notna()
+    assert income == pytest.approx(df.loc[is_income, "Сумма"].sum(), rel=1e-12)
+    assert expenses == pytest.approx(df.loc[has_category & ~is_income, "_abs_sum"].sum(), rel=1e-12)
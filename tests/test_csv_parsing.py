@@ -0,0 +1,78 @@
+"""
+Разбор CSV-выписок: Arrow-парсер и pandas-fallback должны давать тот же результат,
+что и исходный разбор через pd.read_csv с последующей валидацией дат и сумм.
+"""
+import io
+
+import pandas as pd
+import pytest
+
+import transaction_analyzer
+from transaction_analyzer import TransactionAnalyzer
+
+
+ISO_CSV = (
+    "Дата,Назначение платежа,Сумма,Лишняя\n"
+    "2025-01-15,Оплата аренды ООО Ромашка,-50000.5,x\n"
+    "2025-02-01,Оплата от клиента 7,120000,y\n"
+    "2025-02-03,Закупка сырья,-3500,z\n"
+)
+DOTTED_CSV = (
+    "Дата,Назначение платежа,Сумма\n"
+    "15.01.2025,Оплата аренды ООО Ромашка,-50000.5\n"
+    "01.02.2025,Оплата от клиента 7,120000\n"
+    "03.02.2025,,-3500\n"
+)
+# Некорректная сумма не укладывается в схему Arrow: файл дочитывается pandas с валидацией
+BAD_AMOUNT_CSV = (
+    "Дата,Назначение платежа,Сумма\n"
+    "2025-01-15,Оплата аренды,-50000.5\n"
+    "2025-01-16,Реклама ВК,abc\n"
+    "2025-01-17,Оплата от клиента 2,700\n"
+)
+
+
+def baseline_parse(data: str) -> pd.DataFrame:
+    """Исходный разбор: все колонки через pandas, затем даты (ISO, иначе dayfirst) и суммы."""
+    df = pd.read_csv(io.StringIO(data))
+    dates = pd.to_datetime(df["Дата"], errors="coerce", format="%Y-%m-%d")
+    mask = dates.isna()
+    if mask.any():
+        dates[mask] = pd.to_datetime(df["Дата"][mask], errors="coerce", dayfirst=True)
+    df["Дата"] = dates
+    df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce")
+    df = df.dropna(subset=["Сумма"])
+    return df[["Дата", "Назначение платежа", "Сумма"]]
+
+
+def parse(data: str, use_arrow: bool, monkeypatch) -> pd.DataFrame:
+    monkeypatch.setattr(transaction_analyzer, "PYARROW_AVAILABLE", use_arrow)
+    df = TransactionAnalyzer.parse_transactions(io.BytesIO(data.encode("utf-8")), "statement.csv")
+    return df[["Дата", "Назначение платежа", "Сумма"]]
+
+
+@pytest.mark.parametrize("data", [ISO_CSV, DOTTED_CSV, BAD_AMOUNT_CSV], ids=["iso", "dotted", "bad_amount"])
+@pytest.mark.parametrize("use_arrow", [True, False], ids=["arrow", "pandas"])
+def test_csv_parsing_matches_baseline(data, use_arrow, monkeypatch):
+    if use_arrow:
+        pytest.importorskip("pyarrow")
+    result = parse(data, use_arrow, monkeypatch)
+    pd.testing.assert_frame_equal(
+        result.reset_index(drop=True), baseline_parse(data).reset_index(drop=True), check_dtype=False
+    )
+
+
+@pytest.mark.parametrize("data", [ISO_CSV, DOTTED_CSV], ids=["iso", "dotted"])
+def test_arrow_reads_well_formed_csv(data):
+    pytest.importorskip("pyarrow")
+    assert TransactionAnalyzer._read_csv_arrow(io.BytesIO(data.encode("utf-8"))) is not None
+
+
+def test_arrow_falls_back_to_pandas_on_bad_amount():
+    pytest.importorskip("pyarrow")
+    assert TransactionAnalyzer._read_csv_arrow(io.BytesIO(BAD_AMOUNT_CSV.encode("utf-8"))) is None
+
+
+def test_missing_column_is_reported(monkeypatch):
+    with pytest.raises(ValueError, match="Сумма"):
+        parse("Дата,Назначение платежа\n2025-01-15,Оплата\n", True, monkeypatch)
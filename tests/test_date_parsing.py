@@ -0,0 +1,55 @@
+"""
+Разбор колонки дат по формату, определенному на выборке: результат должен совпадать
+с исходным поэлементным разбором (ISO, затем автоопределение с dayfirst, затем префикс YYYY-MM-DD).
+"""
+import pandas as pd
+import pytest
+
+import transaction_analyzer
+from transaction_analyzer import TransactionAnalyzer
+
+
+def baseline_parse_dates(dates: pd.Series) -> pd.Series:
+    """Исходный разбор дат из parse_transactions до определения формата по выборке."""
+    parsed = pd.to_datetime(dates, errors="coerce", dayfirst=False, format="%Y-%m-%d")
+    if parsed.isna().any():
+        mask = parsed.isna()
+        parsed[mask] = pd.to_datetime(dates[mask], errors="coerce", dayfirst=True)
+    if parsed.isna().any():
+        for idx in parsed[parsed.isna()].index:
+            date_str = str(dates.loc[idx]).strip()
+            if len(date_str) >= 10 and date_str[4] == "-" and date_str[7] == "-":
+                value = pd.to_datetime(date_str[:10], format="%Y-%m-%d", errors="coerce")
+                if pd.notna(value):
+                    parsed[idx] = value
+    return parsed
+
+
+CASES = {
+    "iso": ["2025-01-15", "2025-02-01", "2024-12-31"],
+    "dotted": ["15.01.2025", "01.02.2025", "31.12.2024"],
+    "iso_with_time": ["2025-01-15 10:30", "2025-02-01T08:00:00", "2025-03-05"],
+    "with_garbage": ["2025-01-15", "не дата", None, "2025-02-30", "2025-03-05"],
+    "mixed": ["15.01.2025", "2025-02-01", "03.02.2025"],
+    "slashed_with_iso": ["15/01/2025", "2025-02-01", "03/02/2025"],
+}
+
+
+@pytest.mark.parametrize("values", CASES.values(), ids=CASES.keys())
+def test_parse_dates_matches_baseline(values):
+    dates = pd.Series(values, dtype=object)
+    pd.testing.assert_series_equal(TransactionAnalyzer._parse_dates(dates), baseline_parse_dates(dates))
+
+
+def test_format_is_detected_on_sample_only(monkeypatch):
+    # Формат определяется по первым значениям, значения другого формата дочитываются фолбэками
+    monkeypatch.setattr(transaction_analyzer, "DATE_FORMAT_SAMPLE_SIZE", 3)
+    dates = pd.Series(["15.01.2025", "16.01.2025", "17.01.2025", "2025-01-18", "19.01.2025"], dtype=object)
+    result = TransactionAnalyzer._parse_dates(dates)
+    pd.testing.assert_series_equal(result, baseline_parse_dates(dates))
+    assert result.notna().all()
+
+
+def test_datetime_column_is_returned_as_is():
+    dates = pd.Series(pd.to_datetime(["2025-01-15", "2025-02-01"]))
+    assert TransactionAnalyzer._parse_dates(dates) is dates
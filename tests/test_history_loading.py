@@ -0,0 +1,107 @@
+"""
+Загрузка истории транзакций: окно по индексу .idx и дочитывание дописанного хвоста
+должны давать те же транзакции, что и исходный полный разбор файла.
+"""
+import json
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from transaction_history import INDEX_RECORD, TransactionHistory
+
+
+def make_entries(seed: int, days: int = 400, step: int = 3):
+    """Записи истории от самой старой к новой: (время записи, транзакции)."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    entries = []
+    for days_ago in range(days, 0, -step):
+        transactions = [
+            {
+                "Дата": (now - timedelta(days=rng.randint(0, 500))).strftime("%Y-%m-%d"),
+                "Сумма": round(rng.uniform(-90_000, 90_000), 2),
+                "Категория": rng.choice(["Аренда", "Реклама", "Поступление от клиента"]),
+                "Контрагент": rng.choice(["Ромашка", "Вектор", "—"]),
+            }
+            for _ in range(rng.randint(0, 5))
+        ]
+        entries.append((now - timedelta(days=days_ago, hours=12), transactions))
+    return entries
+
+
+def write_history(path: str, entries, index_shift: int = 0) -> None:
+    """Пишет файл истории и индекс в формате save_transactions; index_shift портит смещения индекса."""
+    with open(path, "wb") as history, open(path + ".idx", "wb") as index:
+        for entry_date, transactions in entries:
+            index.write(INDEX_RECORD.pack(history.tell() + index_shift, TransactionHistory._to_micros(entry_date)))
+            line = {"timestamp": entry_date.isoformat(), "metadata": {}, "transactions": transactions}
+            history.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+def baseline_transactions(path: str, days_back: int):
+    """Исходный get_historical_transactions: полный построчный разбор и копии с _entry_timestamp."""
+    cutoff_date = datetime.now() - timedelta(days=days_back)
+    result = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if datetime.fromisoformat(entry["timestamp"]) >= cutoff_date:
+                for tx in entry.get("transactions", []):
+                    result.append({**tx, "_entry_timestamp": entry["timestamp"]})
+    return result
+
+
+@pytest.fixture
+def history_path(tmp_path):
+    path = str(tmp_path / "transaction_history.jsonl")
+    write_history(path, make_entries(seed=5))
+    return path
+
+
+def test_windowed_loading_matches_full_scan(history_path):
+    history = TransactionHistory(history_path)
+    assert history.get_historical_transactions(30) == baseline_transactions(history_path, 30)
+    # Короткое окно найдено по индексу: начало файла не разбиралось
+    assert history._cache_start > 0
+    for days_back in (90, 365, 1000):
+        assert history.get_historical_transactions(days_back) == baseline_transactions(history_path, days_back)
+    assert history._cache_start == 0
+
+
+def test_misaligned_index_is_ignored(tmp_path):
+    path = str(tmp_path / "transaction_history.jsonl")
+    write_history(path, make_entries(seed=6), index_shift=3)
+    history = TransactionHistory(path)
+    assert history.get_historical_transactions(30) == baseline_transactions(path, 30)
+    assert history._cache_start == 0
+
+
+def test_appended_tail_is_parsed_incrementally(history_path, monkeypatch):
+    history = TransactionHistory(history_path)
+    history.get_historical_transactions(365)
+    parsed_size = history._cache_offset
+
+    read_starts = []
+    original_read_entries = history._read_entries
+
+    def spy_read_entries(start, end=None):
+        read_starts.append(start)
+        return original_read_entries(start, end)
+
+    monkeypatch.setattr(history, "_read_entries", spy_read_entries)
+    # Дописывает другой экземпляр, как второй процесс
+    writer = TransactionHistory(history_path)
+    writer.save_transactions([{"Дата": "2025-06-01", "Сумма": -100.0, "Категория": "Аренда", "Контрагент": "Ромашка"}])
+    writer.close()
+
+    assert history.get_historical_transactions(365) == baseline_transactions(history_path, 365)
+    assert read_starts == [parsed_size]
+
+
+def test_returned_transactions_are_json_serializable(history_path):
+    history = TransactionHistory(history_path)
+    json.dumps(history.get_historical_transactions(365), ensure_ascii=False)
+    json.dumps(history.get_counterparty_history("Ромашка", 365), ensure_ascii=False)
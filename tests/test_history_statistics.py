@@ -0,0 +1,82 @@
+"""
+Статистика истории по категориям (np.bincount по кодам категорий и помесячные суммы)
+должна совпадать с исходным поэлементным расчетом get_category_statistics.
+"""
+import random
+from collections import defaultdict
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from transaction_history import TransactionHistory
+
+
+CATEGORIES = ["Аренда", "Реклама", "Поступление от клиента", "Зарплата"]
+
+
+def baseline_statistics(transactions, category):
+    """Исходный get_category_statistics по списку транзакций окна."""
+    category_transactions = [tx for tx in transactions if tx.get("Категория") == category]
+    if not category_transactions:
+        return {"count": 0, "total": 0, "mean": 0, "std": 0, "min": 0, "max": 0, "monthly_totals": {}}
+    amounts = [abs(float(tx.get("Сумма", 0))) for tx in category_transactions]
+    monthly_totals = defaultdict(float)
+    for tx in category_transactions:
+        try:
+            date_str = tx.get("Дата", "")
+            if isinstance(date_str, str):
+                date = datetime.fromisoformat(date_str.split("T")[0])
+                monthly_totals[date.strftime("%Y-%m")] += abs(float(tx.get("Сумма", 0)))
+        except (ValueError, AttributeError):
+            continue
+    return {
+        "count": len(category_transactions),
+        "total": sum(amounts),
+        "mean": sum(amounts) / len(amounts),
+        "std": pd.Series(amounts).std() if len(amounts) > 1 else 0,
+        "min": min(amounts),
+        "max": max(amounts),
+        "monthly_totals": dict(monthly_totals),
+    }
+
+
+@pytest.fixture
+def history(tmp_path):
+    rng = random.Random(11)
+    history = TransactionHistory(str(tmp_path / "transaction_history.jsonl"))
+    for _ in range(40):
+        transactions = []
+        for _ in range(rng.randint(0, 8)):
+            day = datetime(2025, rng.randint(1, 12), rng.randint(1, 28))
+            date = rng.choice([day.strftime("%Y-%m-%d"), day.strftime("%Y-%m-%dT10:00:00"), "", None, "не дата"])
+            transactions.append({
+                "Дата": date,
+                "Сумма": round(rng.uniform(-90_000, 90_000), 2),
+                "Категория": rng.choice(CATEGORIES),
+            })
+        history.save_transactions(transactions, flush=False)
+    history.flush()
+    return history
+
+
+def test_category_statistics_match_baseline(history):
+    # Категория без транзакций возвращает пустую статистику
+    categories = CATEGORIES + ["Налоги"]
+    transactions = history.get_historical_transactions(90)
+    stats = history.get_category_statistics_bulk(categories, 90)
+    for category in categories:
+        expected = baseline_statistics(transactions, category)
+        result = stats[category]
+        assert result["count"] == expected["count"]
+        for field in ("total", "mean", "std", "min", "max"):
+            assert result[field] == pytest.approx(expected[field], rel=1e-9, abs=1e-9)
+        assert result["monthly_totals"].keys() == expected["monthly_totals"].keys()
+        for month, total in expected["monthly_totals"].items():
+            assert result["monthly_totals"][month] == pytest.approx(total, rel=1e-9)
+
+
+def test_single_category_statistics_match_bulk(history):
+    bulk = history.get_category_statistics_bulk(CATEGORIES, 90)
+    for category in CATEGORIES:
+        assert history.get_category_statistics(category, 90) == bulk[category]
@@ -0,0 +1,55 @@
+"""Кэш ответов LLM: сохранение и чтение через SQLite, нормализация ключей и их различение."""
+import pytest
+
+from llm_cache import LLMCache
+
+
+RESULT = {"category": "Аренда", "subcategory": "Офис", "counterparty": "Ромашка", "project": "—"}
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "llm_cache.sqlite")
+
+
+def test_round_trip_through_sqlite(cache_path):
+    LLMCache(cache_path).set_many("model", ["Оплата аренды ООО «Ромашка»"], [RESULT])
+    # Новый экземпляр с пустым in-memory LRU читает значение из SQLite
+    assert LLMCache(cache_path).get_many("model", ["Оплата аренды ООО «Ромашка»", "Реклама ВК"]) == [RESULT, None]
+
+
+def test_key_ignores_case_punctuation_and_yo(cache_path):
+    cache = LLMCache(cache_path)
+    cache.set_many("model", ["Оплата счёта, ООО «Ромашка»"], [RESULT])
+    assert cache.get_many("model", ["оплата  счета ООО Ромашка"]) == [RESULT]
+
+
+@pytest.mark.parametrize(
+    "stored, requested",
+    [
+        (("model", "ИП Иванов 1", 0), ("model", "ИП Иванов 2", 0)),
+        (("model", "Возврат ООО Альфа", 1), ("model", "Возврат ООО Альфа", -1)),
+        (("model", "Возврат ООО Альфа", 0), ("other-model", "Возврат ООО Альфа", 0)),
+    ],
+    ids=["digits", "direction", "model"],
+)
+def test_distinct_keys_do_not_collide(cache_path, stored, requested):
+    cache = LLMCache(cache_path)
+    model, text, direction = stored
+    cache.set_many(model, [text], [RESULT], [direction])
+    model, text, direction = requested
+    assert cache.get_many(model, [text], [direction]) == [None]
+
+
+def test_memory_lru_is_bounded(cache_path):
+    cache = LLMCache(cache_path, memory_size=2)
+    cache.set_many("model", ["a", "b", "c"], [RESULT] * 3)
+    assert len(cache._memory) == 2
+    assert cache.get_many("model", ["a", "b", "c"]) == [RESULT] * 3
+
+
+def test_disabled_cache_stores_nothing(cache_path):
+    cache = LLMCache(cache_path, enabled=False)
+    cache.set_many("model", ["Реклама ВК"], [RESULT])
+    assert cache.get_many("model", ["Реклама ВК"]) == [None]
+    assert LLMCache(cache_path).get_many("model", ["Реклама ВК"]) == [None]
@@ -0,0 +1,116 @@
+"""
+Лог использования токенов: записи через очередь фонового потока после flush/save_reports
+должны давать тот же полный лог и тот же агрегат, что и исходный расчет через groupby.
+"""
+import glob
+import os
+import random
+import types
+
+import pandas as pd
+import pytest
+
+import token_logger as token_logger_module
+from token_logger import FULL_LOG_FIELDS, TokenUsageLogger
+
+
+@pytest.fixture(autouse=True)
+def enable_logging(monkeypatch):
+    monkeypatch.setattr(token_logger_module, "LOGGING_TOKEN_USAGE", True)
+
+
+def make_records(n: int = 200):
+    rng = random.Random(3)
+    records = []
+    for i in range(n):
+        prompt, completion = rng.randint(50, 500), rng.randint(5, 80)
+        records.append({
+            "model_name": rng.choice(["model-a", "model-b"]),
+            "task": rng.choice(["categorize_batch", "consultant", "router"]),
+            "task_data": f"call={i}",
+            "prompt_tokens": prompt,
+            "completion_tokens": completion,
+            "total_tokens": prompt + completion,
+        })
+    return records
+
+
+def log_records(logger: TokenUsageLogger, records) -> None:
+    for record in records:
+        usage = types.SimpleNamespace(**{field: record[field] for field in FULL_LOG_FIELDS[3:]})
+        logger.log_usage(usage, record["model_name"], record["task"], record["task_data"])
+
+
+def baseline_report(records) -> pd.DataFrame:
+    """Исходный агрегат save_reports: groupby по модели и задаче по всему полному логу."""
+    by_model_task = pd.DataFrame(records).groupby(["model_name", "task"]).agg(
+        prompt_tokens=("prompt_tokens", "sum"),
+        completion_tokens=("completion_tokens", "sum"),
+        total_tokens=("total_tokens", "sum"),
+        call_count=("model_name", "size"),
+    ).reset_index()
+    by_model_task["percentage_of_total"] = (
+        by_model_task["total_tokens"] / by_model_task["total_tokens"].sum() * 100
+    ).round(2)
+    return by_model_task
+
+
+def read_report(output_dir: str) -> pd.DataFrame:
+    (path,) = glob.glob(os.path.join(output_dir, "*_token_usage_by_model_task.csv"))
+    return pd.read_csv(path)
+
+
+@pytest.mark.parametrize("use_parquet", [True, False], ids=["parquet", "csv"])
+def test_save_reports_matches_baseline(tmp_path, use_parquet):
+    if use_parquet:
+        pytest.importorskip("pyarrow")
+    logger = TokenUsageLogger(output_dir=str(tmp_path))
+    logger.use_parquet = use_parquet
+    if not use_parquet:
+        logger.full_log_path += ".csv"
+    records = make_records()
+    log_records(logger, records)
+    logger.save_reports(str(tmp_path))
+
+    pd.testing.assert_frame_equal(read_report(str(tmp_path)), baseline_report(records))
+    if use_parquet:
+        full_log = pd.read_parquet(logger.full_log_path)
+    else:
+        full_log = pd.read_csv(logger.full_log_path)
+    pd.testing.assert_frame_equal(full_log, pd.DataFrame(records), check_dtype=False)
+
+
+def test_each_report_writes_one_parquet_part(tmp_path):
+    pytest.importorskip("pyarrow")
+    logger = TokenUsageLogger(output_dir=str(tmp_path))
+    records = make_records(30)
+    log_records(logger, records[:10])
+    logger.flush()
+    # Обычный flush не порождает мелкую часть, сохранение отчета — порождает
+    assert not os.path.exists(logger.full_log_path)
+    logger.save_reports(str(tmp_path))
+    log_records(logger, records[10:])
+    logger.save_reports(str(tmp_path))
+    assert sorted(os.listdir(logger.full_log_path)) == ["part-00000.parquet", "part-00001.parquet"]
+    pd.testing.assert_frame_equal(pd.read_parquet(logger.full_log_path), pd.DataFrame(records), check_dtype=False)
+
+
+def test_bad_record_does_not_stop_writer(tmp_path):
+    logger = TokenUsageLogger(output_dir=str(tmp_path))
+    records = make_records(5)
+    log_records(logger, records[:2])
+    # Запись без обязательных полей не должна останавливать фоновый поток и портить полный лог
+    logger._queue.put({"task": "broken"})
+    log_records(logger, records[2:])
+    assert logger.flush()
+    assert logger._writer_thread.is_alive()
+    logger.save_reports(str(tmp_path))
+    pd.testing.assert_frame_equal(read_report(str(tmp_path)), baseline_report(records))
+    if logger.use_parquet:
+        pd.testing.assert_frame_equal(pd.read_parquet(logger.full_log_path), pd.DataFrame(records), check_dtype=False)
+
+
+def test_flush_without_records_does_not_start_thread(tmp_path):
+    logger = TokenUsageLogger(output_dir=str(tmp_path))
+    assert logger.flush()
+    assert logger._writer_thread is None
@@ -1,5 +1,6 @@
 import datetime
 import functools
+import inspect
 import os
 import threading
 import time
@@ -78,7 +79,20 @@ time_logger = TimeUsageLogger()
 
 
 def timed(func):
-    """Декоратор для измерения времени выполнения функции."""
+    """Декоратор для измерения времени выполнения функции (поддерживает и корутины)."""
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not LOGGING_TIME_USAGE:
+                return await func(*args, **kwargs)
+            start_time = time.perf_counter()
+            result = await func(*args, **kwargs)
+            duration = time.perf_counter() - start_time
+            time_logger.log_time(func.__name__, duration)
+            return result
+
+        return async_wrapper
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -1,49 +1,192 @@
+import atexit
+import csv
 import datetime
 import os
+import queue
 import threading
 
 import pandas as pd
 
 from config import LOGGING_TOKEN_USAGE
 
+# Parquet для полного лога (опционально)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+
+FULL_LOG_FIELDS = ["model_name", "task", "task_data", "prompt_tokens", "completion_tokens", "total_tokens"]
+TOKEN_FIELDS = ["prompt_tokens", "completion_tokens", "total_tokens"]
+# Количество строк, после которого накопленные записи сбрасываются в очередную часть Parquet-лога
+FULL_LOG_PART_ROWS = 10_000
+# Сколько секунд flush() ждет фоновый поток, прежде чем продолжить без него
+FLUSH_TIMEOUT_SECONDS = 30
+
+if PYARROW_AVAILABLE:
+    FULL_LOG_SCHEMA = pa.schema(
+        [(field, pa.string()) for field in FULL_LOG_FIELDS[:3]]
+        + [(field, pa.int64()) for field in TOKEN_FIELDS]
+    )
+# Форматирование колонок сводного отчета при выводе в консоль
+REPORT_FORMATTERS = {
+    **{col: "{:,}".format for col in TOKEN_FIELDS + ["call_count"]},
+    "percentage_of_total": "{:.2f}%".format,
+}
+
 
 class TokenUsageLogger:
-    def __init__(self):
-        self.data = []
+    def __init__(self, output_dir="logs"):
+        # Суммы токенов и число вызовов по парам (модель, задача) считаются по мере поступления записей
+        self._by_mt = {}
         self._lock = threading.Lock()
+        # Записи передаются фоновому потоку через очередь, чтобы log_usage не ждал блокировку и запись на диск
+        self._queue = queue.SimpleQueue()
+        self._writer_thread = None
         self.run_timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.output_dir = output_dir
+        # При наличии pyarrow полный лог пишется в Parquet (Snappy) как набор файлов-частей в каталоге:
+        # часть пишется по достижении FULL_LOG_PART_ROWS строк, при сохранении отчетов и при завершении процесса.
+        # Иначе — построчно в CSV
+        self.use_parquet = PYARROW_AVAILABLE
+        full_log_name = f"{self.run_timestamp}_token_usage_full_log"
+        self.full_log_path = os.path.join(output_dir, full_log_name if self.use_parquet else f"{full_log_name}.csv")
+        self._full_log_file = None
+        self._full_log_writer = None
+        self._pending_rows = []
+        self._part_index = 0
+
+    def _get_full_log_writer(self) -> csv.DictWriter:
+        """Лениво открывает файл полного лога; строки пишутся в него по мере поступления."""
+        if self._full_log_writer is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._full_log_file = open(self.full_log_path, "w", encoding="utf-8", newline="")
+            self._full_log_writer = csv.DictWriter(self._full_log_file, fieldnames=FULL_LOG_FIELDS)
+            self._full_log_writer.writeheader()
+        return self._full_log_writer
+
+    def _write_parquet_part(self) -> None:
+        """Записывает накопленные строки в очередной файл-часть Parquet-лога."""
+        if not self._pending_rows:
+            return
+        os.makedirs(self.full_log_path, exist_ok=True)
+        table = pa.Table.from_pylist(self._pending_rows, schema=FULL_LOG_SCHEMA)
+        part_path = os.path.join(self.full_log_path, f"part-{self._part_index:05d}.parquet")
+        pq.write_table(table, part_path, compression="snappy")
+        self._part_index += 1
+        self._pending_rows = []
+
+    def _write_full_log_row(self, item: dict) -> None:
+        """Добавляет запись в полный лог."""
+        if self.use_parquet:
+            self._pending_rows.append(item)
+            if len(self._pending_rows) >= FULL_LOG_PART_ROWS:
+                self._write_parquet_part()
+        else:
+            self._get_full_log_writer().writerow(item)
+
+    def _ensure_writer_thread(self) -> None:
+        """Лениво запускает фоновый поток, который разбирает очередь записей."""
+        if self._writer_thread is None:
+            with self._lock:
+                if self._writer_thread is None:
+                    self._writer_thread = threading.Thread(target=self._drain_queue, daemon=True)
+                    self._writer_thread.start()
+
+    def _drain_queue(self) -> None:
+        """Цикл фонового потока: пишет записи в полный лог и обновляет агрегаты для отчета."""
+        while True:
+            item = self._queue.get()
+            try:
+                if isinstance(item, tuple):
+                    # Маркер от flush(): все записи до него уже обработаны
+                    _, write_pending = item
+                    if self.use_parquet:
+                        # Неполная часть пишется только по запросу (отчет, завершение), а не на каждый flush
+                        if write_pending:
+                            self._write_parquet_part()
+                    elif self._full_log_file is not None:
+                        self._full_log_file.flush()
+                else:
+                    # Агрегация обращается ко всем полям записи, поэтому идет первой: неполная запись
+                    # не попадет в буфер Parquet-части, где сломала бы запись всей части
+                    self._aggregate(item)
+                    self._write_full_log_row(item)
+            except Exception as e:
+                # Ошибка одной записи не должна останавливать поток: иначе очередь перестанет разбираться
+                print(f"[ERROR] Ошибка записи лога использования токенов: {e}")
+            finally:
+                if isinstance(item, tuple):
+                    item[0].set()
+
+    def _aggregate(self, item: dict) -> None:
+        """Добавляет запись к накопленным суммам по паре (модель, задача)."""
+        key = (item["model_name"], item["task"])
+        with self._lock:
+            totals = self._by_mt.get(key)
+            if totals is None:
+                totals = self._by_mt[key] = dict.fromkeys(TOKEN_FIELDS + ["call_count"], 0)
+            for field in TOKEN_FIELDS:
+                totals[field] += item[field]
+            totals["call_count"] += 1
+
+    def flush(self, write_pending: bool = False) -> bool:
+        """
+        Дожидается обработки всех записей, поставленных в очередь до вызова.
+        При write_pending=True дописывает на диск и неполную часть Parquet-лога.
+        Возвращает False, если фоновый поток не успел обработать записи.
+        """
+        if self._writer_thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put((done, write_pending))
+        if not done.wait(timeout=FLUSH_TIMEOUT_SECONDS):
+            print(f"[WARN] Лог использования токенов не записан за {FLUSH_TIMEOUT_SECONDS} с, продолжаем без ожидания")
+            return False
+        return True
+
+    def close(self) -> None:
+        """Дописывает остаток полного лога; вызывается при завершении процесса."""
+        self.flush(write_pending=True)
 
     def log_usage(self, usage, model_name: str, task: str, task_data: str) -> None:
         """Сохраняет данные об использовании токенов моделью"""
         if not LOGGING_TOKEN_USAGE:
             return
-        with self._lock:
-            log = {
-                "model_name": model_name,
-                "task": task,
-                "task_data": task_data,
-                "prompt_tokens": getattr(usage, 'prompt_tokens', 0),
-                "completion_tokens": getattr(usage, 'completion_tokens', 0),
-                "total_tokens": getattr(usage, 'total_tokens', 0),
-            }
-            self.data.append(log)
+        self._ensure_writer_thread()
+        self._queue.put({
+            "model_name": model_name,
+            "task": task,
+            "task_data": task_data,
+            "prompt_tokens": getattr(usage, 'prompt_tokens', 0),
+            "completion_tokens": getattr(usage, 'completion_tokens', 0),
+            "total_tokens": getattr(usage, 'total_tokens', 0),
+        })
 
     def save_reports(self, output_dir="logs"):
         if not LOGGING_TOKEN_USAGE:
-            pass
+            return
+        # Накопленные строки сохраняются отдельной частью: одна часть на отчет, а не на каждую запись
+        flushed = self.flush(write_pending=True)
+        with self._lock:
+            rows = [
+                {"model_name": model_name, "task": task, **totals}
+                for (model_name, task), totals in self._by_mt.items()
+            ]
+        if not rows:
+            return
         os.makedirs(output_dir, exist_ok=True)
 
-        full_log_df = pd.DataFrame(self.data)
-        full_log_path = os.path.join(output_dir, f"{self.run_timestamp}_token_usage_full_log.csv")
-        full_log_df.to_csv(full_log_path, index=False, encoding='utf-8')
-        print(f"\nПолный лог использования токенов сохранен в: {full_log_path}")
+        if flushed and os.path.exists(self.full_log_path):
+            print(f"\nПолный лог использования токенов сохранен в: {self.full_log_path}")
+        else:
+            print(f"\n[WARN] Полный лог использования токенов сохранен не полностью: {self.full_log_path}")
 
-        by_model_task = full_log_df.groupby(['model_name', 'task']).agg(
-            prompt_tokens=('prompt_tokens', 'sum'),
-            completion_tokens=('completion_tokens', 'sum'),
-            total_tokens=('total_tokens', 'sum'),
-            call_count=('model_name', 'size')
-        ).reset_index()
+        # Размер агрегата равен числу уникальных пар (модель, задача), а не числу вызовов
+        rows.sort(key=lambda row: (str(row["model_name"]), str(row["task"])))
+        by_model_task = pd.DataFrame(rows)
 
         total_tokens_overall = by_model_task['total_tokens'].sum()
         if total_tokens_overall > 0:
@@ -54,15 +197,9 @@ class TokenUsageLogger:
         print(f"Агрегированный отчет по задачам сохранен в: {by_model_task_path}")
 
         print("\n--- Сводный отчет по использованию токенов (Модель + Задача) ---")
-        by_model_task_display = by_model_task.copy()
-        for col in ['prompt_tokens', 'completion_tokens', 'total_tokens', 'call_count']:
-            by_model_task_display[col] = by_model_task_display[col].apply(lambda x: f"{x:,}")
-        if 'percentage_of_total' in by_model_task_display.columns:
-            by_model_task_display['percentage_of_total'] = by_model_task_display['percentage_of_total'].apply(
-                lambda x: f"{x}%")
-
-        print(by_model_task_display.to_string(index=False))
+        print(by_model_task.to_string(index=False, formatters=REPORT_FORMATTERS))
         print("-----------------------------------------------------------------")
 
 
 token_logger = TokenUsageLogger()
+atexit.register(token_logger.close)
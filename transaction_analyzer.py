@@ -1,20 +1,40 @@
 import pandas as pd
 import io
 import json
+import re
 import numpy as np
 import asyncio
 import time
+import hashlib
+import heapq
+import random
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, deque
+from statistics import fmean
 from typing import List, Optional, Dict, Tuple
 
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
 from time_logger import timed
 from token_logger import token_logger
-from config import TRANSACTION_ANALYZER_CONFIG
+from config import TRANSACTION_ANALYZER_CONFIG, LOGGING_ANALYSIS_DEBUG
 from transaction_history import transaction_history
+from llm_cache import llm_cache
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError, field_validator, model_validator
+
+# Многопоточный парсер CSV из Arrow (опционально)
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pacsv
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
 
 
 CATEGORIES = [
@@ -31,6 +51,170 @@ SUBCATEGORIES = {
     "Зарплата": ["Оклад", "Премия", "Налоги с ФОТ"]
 }
 
+# Неизменяемые части промптов собираются один раз при импорте модуля
+CATEGORIES_STR = ", ".join(CATEGORIES)
+SUBCATEGORIES_STR = {category: ", ".join(subs) for category, subs in SUBCATEGORIES.items()}
+
+# Множества для проверки принадлежности за O(1) при валидации ответов LLM
+CATEGORIES_SET = frozenset(CATEGORIES)
+SUBCATEGORIES_SETS = {category: frozenset(subs) for category, subs in SUBCATEGORIES.items()}
+SUBCATEGORIES_JSON = json.dumps(SUBCATEGORIES, ensure_ascii=False, indent=2)
+
+# Промпты разделены на неизменяемый системный префикс и пользовательское сообщение
+# с данными транзакций: одинаковый префикс переиспользуется кэшем промптов провайдера
+BATCH_SYSTEM_PROMPT = f"""Ты — AI-бухгалтер. Проанализируй транзакции из сообщения пользователя и верни JSON с результатами.
+
+Категории: {CATEGORIES_STR}
+
+Подкатегории (по категориям):
+{SUBCATEGORIES_JSON}
+
+Для каждой транзакции определи:
+1. category - главная категория из списка выше
+2. subcategory - подкатегория (если есть в списке для данной категории, иначе "—")
+3. counterparty - название компании/ИП (очисти от ООО, за, согласно, НДС, договор), если не найдено - "—"
+4. project - проект/ЦЗ (ищи ключевые слова: Москва-Сити, Ребрендинг, Проект, ЦЗ), если не найдено - "—"
+
+Верни JSON-объект, в котором results — массив результатов в порядке транзакций:
+{{"results": [
+  {{"category": "Категория", "subcategory": "Подкатегория", "counterparty": "Название", "project": "Проект"}},
+  ...
+]}}"""
+
+# Промпты fallback-обработки отдельных транзакций
+MAIN_CATEGORY_SYSTEM_PROMPT = (
+    "Ты — AI-бухгалтер. Определи главную категорию транзакции из сообщения пользователя.\n"
+    f"Категории: {CATEGORIES_STR}.\n"
+    "Если расход нельзя учесть по УСН, выбери 'Не принимаемые расходы'.\n"
+    "Ответь только одним словом — названием категории."
+)
+SUBCATEGORY_SYSTEM_PROMPTS = {
+    category: (
+        "Ты — AI-бухгалтер. Определи подкатегорию транзакции из сообщения пользователя.\n"
+        f"Главная категория: {category}.\n"
+        f"Подкатегории: {subcategories}.\n"
+        "Если подкатегорию определить невозможно, ответь '—'.\n"
+        "Ответь только одним словом или '—'."
+    )
+    for category, subcategories in SUBCATEGORIES_STR.items()
+}
+COUNTERPARTY_SYSTEM_PROMPT = (
+    "Извлеки название компании или ИП из текста в сообщении пользователя.\n"
+    "Очисти от лишних слов (ООО, за, согласно, НДС, договор и т.д.).\n"
+    "Если название не найдено, ответь '—'.\n"
+    "Ответь только названием компании или '—'."
+)
+
+# Временные ошибки API, после которых запрос повторяется (APITimeoutError — подкласс APIConnectionError)
+RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, InternalServerError, asyncio.TimeoutError)
+
+# Обязательные колонки выписки; остальные колонки файла не читаются
+REQUIRED_COLUMNS = ["Дата", "Назначение платежа", "Сумма"]
+
+# Кандидаты формата дат в порядке предпочтения; None — автоопределение с dayfirst=True
+DATE_FORMATS = ["%Y-%m-%d", "%d.%m.%Y", None]
+# Количество значений, по которым определяется формат колонки дат
+DATE_FORMAT_SAMPLE_SIZE = 100
+
+# Порядок рекомендаций в отчете по типу; неизвестные типы идут последними
+RECOMMENDATION_PRIORITY = {"critical": 0, "warning": 1, "info": 2}
+
+# Правила для детерминированной категоризации очевидных транзакций без обращения к LLM.
+# Порядок важен: срабатывает первое совпавшее правило. Третий элемент — направление платежа,
+# к которому применимо правило: 1 — поступление (сумма > 0), -1 — списание (сумма < 0)
+CATEGORY_RULES = [
+    (re.compile(r"оплата от (?:покупател|клиент|заказчик)|поступлени[ея] от (?:покупател|клиент|заказчик)", re.IGNORECASE),
+     "Поступление от клиента", 1),
+    (re.compile(r"аренд", re.IGNORECASE), "Аренда", -1),
+    (re.compile(r"зарплат|заработн", re.IGNORECASE), "Зарплата", -1),
+    (re.compile(r"реклам", re.IGNORECASE), "Реклама", -1),
+]
+
+# Подкатегории ищутся по вхождению названия в текст: одно регулярное выражение на категорию
+SUBCATEGORY_PATTERNS = {
+    category: re.compile("(" + "|".join(re.escape(sub) for sub in subs) + ")", re.IGNORECASE)
+    for category, subs in SUBCATEGORIES.items()
+}
+SUBCATEGORY_CANONICAL = {sub.lower(): sub for subs in SUBCATEGORIES.values() for sub in subs}
+
+# Ключевые слова проектов/центров затрат; порядок задает приоритет при нескольких совпадениях
+PROJECT_KEYWORDS = ["Москва-Сити", "Ребрендинг", "Проект", "ЦЗ"]
+PROJECT_PATTERNS = [(keyword, re.compile(re.escape(keyword), re.IGNORECASE)) for keyword in PROJECT_KEYWORDS]
+
+# Наименование контрагента после организационно-правовой формы: ООО «Ромашка» (название в кавычках целиком)
+# или ИП Иванов (одно слово). Служебные слова и номера («ООО по счету 12», «ИП №5») наименованием не считаются
+COUNTERPARTY_RE = re.compile(
+    r"\b(?:ООО|ОАО|ЗАО|ПАО|АО|ИП)\s+"
+    r"(?:[«\"'](?P<quoted>[^«»\"']+)[»\"']"
+    r"|(?!(?i:за|по|от|на|для|в|во|с|со|и)\b)(?P<word>[^\W\d_][\w-]*))"
+)
+
+class CategorizedTransaction(BaseModel):
+    """
+    Результат категоризации одной транзакции в ответе LLM.
+    Нормализуется при разборе: неизвестные категория и подкатегория заменяются значениями по умолчанию.
+    """
+    category: str = "Прочее"
+    subcategory: str = "—"
+    counterparty: str = "—"
+    project: str = "—"
+
+    @field_validator("category")
+    @classmethod
+    def _known_category(cls, value: str) -> str:
+        return value if value in CATEGORIES_SET else "Прочее"
+
+    @field_validator("counterparty")
+    @classmethod
+    def _strip_counterparty(cls, value: str) -> str:
+        return value.strip() or "—"
+
+    @field_validator("project")
+    @classmethod
+    def _strip_project(cls, value: str) -> str:
+        # Пустой проект дозаполняется эвристикой по тексту транзакции
+        return value.strip()
+
+    @model_validator(mode="after")
+    def _known_subcategory(self) -> "CategorizedTransaction":
+        if self.subcategory not in SUBCATEGORIES_SETS.get(self.category, ()):
+            self.subcategory = "—"
+        return self
+
+class CategorizationBatch(BaseModel):
+    """Ответ LLM на батч транзакций."""
+    results: List[CategorizedTransaction]
+
+# Structured output: декодер модели ограничен схемой, категория — только из CATEGORIES
+CATEGORIZATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "transaction_categorization",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "category": {"type": "string", "enum": CATEGORIES},
+                            "subcategory": {"type": "string"},
+                            "counterparty": {"type": "string"},
+                            "project": {"type": "string"}
+                        },
+                        "required": ["category", "subcategory", "counterparty", "project"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    }
+}
+
 class TaxRow(BaseModel):
     Показатель: str
     Значение: float
@@ -43,34 +227,97 @@ class AnalyzeResponse(BaseModel):
     summary: AnalyzeSummary
     transactions: List[TaxRow]
 
+class RequestRateLimiter:
+    """
+    Ограничитель частоты LLM-запросов по скользящему окну.
+    Хранит время последних запросов и ждет, пока в окне не освободится место.
+    """
+
+    def __init__(self, max_requests: int, period: float = 60.0):
+        self.max_requests = max_requests
+        self.period = period
+        self._timestamps = deque()
+
+    async def acquire(self) -> None:
+        """Дожидается возможности отправить очередной запрос."""
+        if not self.max_requests:
+            return
+        while True:
+            now = time.monotonic()
+            while self._timestamps and now - self._timestamps[0] >= self.period:
+                self._timestamps.popleft()
+            # Проверка и запись выполняются без await, поэтому между корутинами гонки нет
+            if len(self._timestamps) < self.max_requests:
+                self._timestamps.append(now)
+                return
+            await asyncio.sleep(self.period - (now - self._timestamps[0]))
+
+
 class TransactionAnalyzer:
     def __init__(self,
-                 open_router_client: OpenAI,
+                 open_router_client: AsyncOpenAI,
                  generation_model: str,
                  ):
         self.open_router_client = open_router_client
         self.generation_model = generation_model
+        self.rate_limiter = RequestRateLimiter(TRANSACTION_ANALYZER_CONFIG["max_requests_per_minute"])
 
     @staticmethod
-    def calculate_taxes(df: pd.DataFrame, mode: str = "УСН_доходы") -> (float, pd.DataFrame):
-        """Рассчитывает налоговую базу и итоговый налог."""
-        df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce").fillna(0)
+    def calculate_taxes(category_totals: pd.DataFrame, mode: str = "УСН_доходы") -> (float, List[Tuple[str, float]]):
+        """
+        Рассчитывает налоговую базу и итоговый налог по агрегатам категорий (см. _aggregate_by_category).
+        Возвращает налог и строки налоговой таблицы в виде пар (показатель, значение).
+        """
+        income = category_totals["sum"].get("Поступление от клиента", 0.0)
+        expenses = category_totals["sum"].drop("Поступление от клиента", errors="ignore").sum()
 
         if mode == "УСН_доходы":
-            tax_base = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
+            tax_base = income
             rate = 0.06
         else:
-            income = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
-            expenses = df[df["Категория"] != "Поступление от клиента"]["Сумма"].sum()
             tax_base = income - expenses
             rate = 0.15
 
-        tax = max(tax_base * rate, 0)
+        tax = float(max(tax_base * rate, 0))
 
-        return round(tax, 2), pd.DataFrame({
-            "Показатель": ["Налоговая база", "Ставка (%)", "Налог к уплате"],
-            "Значение": [round(tax_base, 2), rate * 100, round(tax, 2)]
-        })
+        return round(tax, 2), [
+            ("Налоговая база", round(float(tax_base), 2)),
+            ("Ставка (%)", rate * 100),
+            ("Налог к уплате", round(tax, 2)),
+        ]
+
+    @staticmethod
+    def _aggregate_by_category(df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Агрегаты по категориям за один линейный проход по кодам категорий (np.bincount):
+        сумма, сумма модулей и количество транзакций. Категории идут в порядке первого появления в выписке.
+        """
+        categories = df["Категория"].cat.categories
+        codes = df["Категория"].cat.codes.to_numpy()
+        amounts = df["Сумма"].to_numpy(dtype=np.float64)
+        abs_amounts = df["_abs_sum"].to_numpy(dtype=np.float64)
+        # Строки без категории (код -1) в агрегаты не попадают, как и в groupby
+        valid = codes >= 0
+        if not valid.all():
+            codes, amounts, abs_amounts = codes[valid], amounts[valid], abs_amounts[valid]
+
+        order = pd.unique(codes)
+        n_categories = len(categories)
+        return pd.DataFrame(
+            {
+                "sum": np.bincount(codes, weights=amounts, minlength=n_categories)[order],
+                "abs_sum": np.bincount(codes, weights=abs_amounts, minlength=n_categories)[order],
+                "count": np.bincount(codes, minlength=n_categories)[order],
+            },
+            index=pd.Index(categories[order], name="Категория"),
+        )
+
+    @staticmethod
+    def _income_and_expenses(category_totals: pd.DataFrame) -> Tuple[float, float]:
+        """Доходы (поступления от клиентов) и расходы (модули сумм остальных категорий) из агрегатов по категориям."""
+        income = category_totals["sum"].get("Поступление от клиента", 0.0)
+        expenses = category_totals["abs_sum"].drop("Поступление от клиента", errors="ignore").sum()
+        return income, expenses
 
     @staticmethod
     @timed
@@ -79,48 +326,44 @@ class TransactionAnalyzer:
         Читает CSV/XLSX и проверяет нужные колонки.
         Добавлена валидация данных: формат дат, проверка на дубликаты.
         """
+        # Читаем только нужные колонки; текст назначения не требует вывода типов
+        read_kwargs = {
+            "usecols": lambda col: col in REQUIRED_COLUMNS,
+            "dtype": {"Назначение платежа": str},
+        }
         if filename.endswith(".csv"):
-            df = pd.read_csv(file_bytes)
+            df = TransactionAnalyzer._read_csv_arrow(file_bytes) if PYARROW_AVAILABLE else None
+            if df is None:
+                file_bytes.seek(0)
+                df = pd.read_csv(file_bytes, **read_kwargs)
         elif filename.endswith(".xlsx"):
-            df = pd.read_excel(file_bytes)
+            # Книга открывается один раз (openpyxl в pandas уже работает в режиме read_only/data_only);
+            # объект ExcelFile можно переиспользовать для чтения других листов без повторного разбора
+            with pd.ExcelFile(file_bytes, engine="openpyxl") as xls:
+                df = xls.parse(xls.sheet_names[0], **read_kwargs)
         else:
             raise ValueError("Поддерживаются только CSV и XLSX файлы")
 
+        for col in REQUIRED_COLUMNS:
+            if col not in df.columns:
+                raise ValueError(f"Отсутствует обязательная колонка: {col}")
+
         if df.empty:
             raise ValueError("Файл пуст или не содержит данных")
 
-        required_cols = ["Дата", "Назначение платежа", "Сумма"]
-        for col in required_cols:
-            if col not in df.columns:
-                raise ValueError(f"Отсутствует обязательная колонка: {col}")
+        # Валидация сумм выполняется до разбора дат: строки с некорректной суммой отбрасываются
+        # сразу и не проходят через дорогой разбор дат и поиск дубликатов
+        df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce")
+        if df["Сумма"].isna().any():
+            na_count = df["Сумма"].isna().sum()
+            print(f"[WARN] {na_count} транзакций с некорректной суммой будут пропущены")
+            df = df.dropna(subset=["Сумма"])
 
         # Валидация и нормализация дат
         try:
-            # Сохраняем исходные даты для восстановления при необходимости
-            original_dates = df["Дата"].copy()
-            
-            # Пробуем парсить как YYYY-MM-DD (стандартный формат)
-            df["Дата"] = pd.to_datetime(df["Дата"], errors="coerce", dayfirst=False, format='%Y-%m-%d')
-            
-            # Если не получилось, пробуем без формата (автоопределение)
-            if df["Дата"].isna().any():
-                mask = df["Дата"].isna()
-                df.loc[mask, "Дата"] = pd.to_datetime(original_dates[mask], errors="coerce", dayfirst=True)
-            
-            # Если все еще есть NaN, пробуем как строки в формате YYYY-MM-DD
-            if df["Дата"].isna().any():
-                mask = df["Дата"].isna()
-                for idx in df[mask].index:
-                    date_str = str(original_dates.loc[idx]).strip()
-                    # Пробуем распарсить как YYYY-MM-DD
-                    if len(date_str) >= 10 and date_str[4] == '-' and date_str[7] == '-':
-                        try:
-                            parsed = pd.to_datetime(date_str[:10], format='%Y-%m-%d', errors="coerce")
-                            if pd.notna(parsed):
-                                df.loc[idx, "Дата"] = parsed
-                        except:
-                            pass
-            
+            original_dates = df["Дата"]
+            df["Дата"] = TransactionAnalyzer._parse_dates(original_dates)
+
             na_count = df["Дата"].isna().sum()
             if na_count > 0:
                 print(f"[WARN] {na_count} дат не удалось распознать из {len(df)} транзакций")
@@ -132,143 +375,190 @@ class TransactionAnalyzer:
             print(f"[WARN] Ошибка при парсинге дат: {e}")
             import traceback
             traceback.print_exc()
+            # Дальше по конвейеру колонка дат используется как datetime64 без повторного разбора
+            df["Дата"] = pd.to_datetime(df["Дата"], errors="coerce")
 
-        # Проверка на дубликаты (по дате, сумме и назначению)
-        duplicates = df.duplicated(subset=["Дата", "Сумма", "Назначение платежа"], keep=False)
-        if duplicates.any():
-            dup_count = duplicates.sum()
+        # Проверка на дубликаты (по дате, сумме и назначению): строки сводятся к одному 64-битному
+        # хэшу (векторизованный хэш pandas), и дубликаты ищутся по числовой колонке, а не по кортежам
+        row_hashes = pd.util.hash_pandas_object(df[["Дата", "Сумма", "Назначение платежа"]], index=False)
+        dup_count = int(row_hashes.duplicated(keep=False).sum())
+        if dup_count:
             print(f"[INFO] Обнаружено {dup_count} потенциальных дубликатов транзакций")
 
-        # Валидация сумм
-        df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce")
-        if df["Сумма"].isna().any():
-            na_count = df["Сумма"].isna().sum()
-            print(f"[WARN] {na_count} транзакций с некорректной суммой будут пропущены")
-            df = df.dropna(subset=["Сумма"])
-
         if df.empty:
             raise ValueError("После валидации не осталось валидных транзакций")
 
         return df
 
+    @staticmethod
+    def _parse_dates(dates: pd.Series) -> pd.Series:
+        """
+        Разбирает колонку дат. Формат определяется один раз по выборке значений, после чего
+        вся колонка разбирается одним векторизованным вызовом. Значения другого формата
+        (смешанные выписки) дочитываются как ISO, автоопределением и по префиксу YYYY-MM-DD.
+        """
+        if pd.api.types.is_datetime64_any_dtype(dates):
+            return dates
+
+        def to_datetime(values, fmt):
+            return pd.to_datetime(values, format=fmt, dayfirst=fmt is None, errors="coerce")
+
+        sample = dates.dropna().head(DATE_FORMAT_SAMPLE_SIZE)
+        date_format = min(DATE_FORMATS, key=lambda fmt: to_datetime(sample, fmt).isna().sum())
+        # Остальные значения дочитываются сначала как ISO, затем автоопределением с dayfirst:
+        # автоопределение переставило бы день и месяц у ISO-дат ("2025-02-01" -> 2 января)
+        formats = [date_format] if date_format else []
+        formats += [fmt for fmt in ("%Y-%m-%d", None) if fmt not in formats]
+        parsed = to_datetime(dates, formats[0])
+        for fallback_format in formats[1:]:
+            mask = parsed.isna() & dates.notna()
+            if mask.any():
+                parsed[mask] = to_datetime(dates[mask], fallback_format)
+        mask = parsed.isna() & dates.notna()
+        if mask.any():
+            # Даты со временем или мусором после даты: "2024-01-15 10:30", "2024-01-15T..."
+            prefixes = dates[mask].astype(str).str.strip().str[:10]
+            parsed[mask] = to_datetime(prefixes, "%Y-%m-%d")
+        return parsed
+
+    @staticmethod
+    def _read_csv_arrow(file_bytes) -> Optional[pd.DataFrame]:
+        """
+        Читает CSV многопоточным парсером Arrow с явными типами колонок: даты (ISO и ДД.ММ.ГГГГ)
+        и суммы разбираются в C. Если файл не укладывается в схему (нет колонки, нестандартная дата
+        или сумма), возвращает None, и файл читается через pandas с полной валидацией.
+        """
+        convert_options = pacsv.ConvertOptions(
+            column_types={
+                "Дата": pa.timestamp("ns"),
+                "Назначение платежа": pa.string(),
+                "Сумма": pa.float64(),
+            },
+            include_columns=REQUIRED_COLUMNS,
+            timestamp_parsers=[pacsv.ISO8601, "%d.%m.%Y"],
+            strings_can_be_null=True,
+        )
+        try:
+            table = pacsv.read_csv(
+                file_bytes,
+                read_options=pacsv.ReadOptions(block_size=8 << 20),
+                convert_options=convert_options,
+            )
+        except (pa.ArrowException, KeyError) as e:
+            print(f"[INFO] CSV не разобран через Arrow ({e}), используется pandas")
+            return None
+        return table.to_pandas()
+
     @timed
-    def categorize_transactions(self, texts: List[str]) -> List[Dict[str, str]]:
+    async def categorize_transactions(self, texts: List[str], directions: Optional[List[int]] = None) -> List[Dict[str, str]]:
         """
         Многоуровневая категоризация с батчингом: один LLM-запрос обрабатывает несколько транзакций.
+        Батчи отправляются параллельно, число одновременных запросов ограничено семафором.
+        Повторяющиеся тексты категоризируются один раз, результат раскладывается по всем вхождениям.
+        directions — направление платежей по каждому тексту: 1 — только поступления, -1 — только списания,
+        0 — смешанные или неизвестно (такие тексты правилами не категоризируются).
         Возвращает список словарей с полями: category, subcategory, counterparty, project.
         """
+        if directions is None:
+            directions = [0] * len(texts)
+        # dict.fromkeys сохраняет порядок первых вхождений, поэтому состав батчей не зависит от дублей
+        keys = list(zip(texts, directions))
+        unique_keys = list(dict.fromkeys(keys))
+        if len(unique_keys) == len(keys):
+            return await self._categorize_unique(list(texts), list(directions))
+        unique_texts = [text for text, _ in unique_keys]
+        unique_directions = [direction for _, direction in unique_keys]
+        unique_results = dict(zip(unique_keys, await self._categorize_unique(unique_texts, unique_directions)))
+        return [unique_results[key] for key in keys]
+
+    async def _categorize_unique(self, texts: List[str], directions: List[int]) -> List[Dict[str, str]]:
+        """Категоризирует список различных текстов: правила, затем кэш, затем батчи LLM."""
         batch_size = TRANSACTION_ANALYZER_CONFIG["batch_size"]
-        results = []
-        
-        # Обрабатываем транзакции батчами
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            batch_results = self._categorize_batch(batch)
-            results.extend(batch_results)
-        
+        semaphore = asyncio.Semaphore(TRANSACTION_ANALYZER_CONFIG["max_concurrent_requests"])
+
+        # Очевидные транзакции категоризируем правилами, остальные ищем в кэше
+        if TRANSACTION_ANALYZER_CONFIG["use_rule_based_categorization"]:
+            results = self._categorize_by_rules(texts, directions)
+        else:
+            results = [None] * len(texts)
+        residual_indices = [i for i, result in enumerate(results) if result is None]
+        # Кэш читает SQLite синхронно, поэтому запрос выполняется в отдельном потоке, не блокируя цикл событий
+        cached_results = await asyncio.to_thread(
+            llm_cache.get_many, self.generation_model,
+            [texts[i] for i in residual_indices], [directions[i] for i in residual_indices]
+        )
+        for idx, result in zip(residual_indices, cached_results):
+            results[idx] = result
+
+        # В LLM отправляем только то, что не покрыто правилами и кэшем
+        missing_indices = [i for i in residual_indices if results[i] is None]
+        missing_texts = [texts[i] for i in missing_indices]
+        missing_directions = [directions[i] for i in missing_indices]
+        # Статистика выводится отдельно: запись в лог токенов с нулевым usage исказила бы число вызовов
+        print(f"[INFO] Категоризация: правилами {len(texts) - len(residual_indices)}, "
+              f"из кэша {len(residual_indices) - len(missing_texts)}, в LLM {len(missing_texts)}")
+
+        async def run_batch(batch: List[str], batch_directions: List[int]) -> List[Dict[str, str]]:
+            async with semaphore:
+                return await self._categorize_batch(batch, batch_directions)
+
+        # Обрабатываем транзакции батчами; gather сохраняет порядок батчей.
+        # Ошибка одного батча не прерывает остальные: его транзакции получают категорию по умолчанию
+        batch_starts = range(0, len(missing_texts), batch_size)
+        batches = [missing_texts[i:i + batch_size] for i in batch_starts]
+        batches_results = await asyncio.gather(
+            *[run_batch(missing_texts[i:i + batch_size], missing_directions[i:i + batch_size]) for i in batch_starts],
+            return_exceptions=True,
+        )
+
+        missing_results = []
+        for batch_idx, (batch, batch_results) in enumerate(zip(batches, batches_results)):
+            if isinstance(batch_results, Exception):
+                print(f"[ERROR] Батч {batch_idx} ({self.generation_model}) не обработан: {batch_results}")
+                batch_results = [CategorizedTransaction().model_dump() for _ in batch]
+            missing_results.extend(batch_results)
+        for idx, result in zip(missing_indices, missing_results):
+            results[idx] = result
         return results
 
-    def _categorize_batch(self, texts: List[str]) -> List[Dict[str, str]]:
+    async def _categorize_batch(self, texts: List[str], directions: List[int]) -> List[Dict[str, str]]:
         """
         Обрабатывает батч транзакций одним LLM-запросом.
+        Направления платежей нужны только для ключей кэша.
         Возвращает JSON-структуру со всеми данными для каждой транзакции.
         """
-        # Формируем промпт для батча
+        # Формируем промпт для батча: меняется только список транзакций
         transactions_list = "\n".join([f"{i+1}. {text}" for i, text in enumerate(texts)])
-        
-        # Создаем JSON-схему для ответа
-        subcategories_json = json.dumps(SUBCATEGORIES, ensure_ascii=False, indent=2)
-        
-        prompt = f"""Ты — AI-бухгалтер. Проанализируй следующие транзакции и верни JSON-массив с результатами.
-
-Транзакции:
-{transactions_list}
-
-Категории: {', '.join(CATEGORIES)}
-
-Подкатегории (по категориям):
-{subcategories_json}
-
-Для каждой транзакции определи:
-1. category - главная категория из списка выше
-2. subcategory - подкатегория (если есть в списке для данной категории, иначе "—")
-3. counterparty - название компании/ИП (очисти от ООО, за, согласно, НДС, договор), если не найдено - "—"
-4. project - проект/ЦЗ (ищи ключевые слова: Москва-Сити, Ребрендинг, Проект, ЦЗ), если не найдено - "—"
-
-Верни ТОЛЬКО валидный JSON-массив в формате:
-[
-  {{"category": "Категория", "subcategory": "Подкатегория", "counterparty": "Название", "project": "Проект"}},
-  ...
-]
-
-Важно: верни ТОЛЬКО JSON, без дополнительного текста."""
+        prompt = f"Транзакции:\n{transactions_list}"
 
         try:
-            response = self._llm_request_with_retry(prompt)
-            
-            # Парсим JSON ответ
-            response_text = response.choices[0].message.content.strip()
-            
-            # Очищаем от markdown code blocks если есть
-            if response_text.startswith("```"):
-                response_text = response_text.split("```")[1]
-                if response_text.startswith("json"):
-                    response_text = response_text[4:]
-                response_text = response_text.strip()
-            
-            batch_results = json.loads(response_text)
+            response = await self._llm_request_with_retry(
+                prompt, BATCH_SYSTEM_PROMPT, response_format=CATEGORIZATION_RESPONSE_FORMAT
+            )
             
-            # Валидация и нормализация результатов
-            validated_results = []
-            if not isinstance(batch_results, list):
-                print(f"[ERROR] Ожидался список, получен: {type(batch_results)}")
-                return self._categorize_fallback(texts)
+            # Ответ ограничен JSON-схемой; pydantic разбирает JSON (pydantic-core, Rust)
+            # и сразу нормализует поля валидаторами модели
+            response_text = response.choices[0].message.content
+            batch_results = CategorizationBatch.model_validate_json(response_text).results
             
-            if len(batch_results) != len(texts):
+            # При несовпадении количества результатов их соответствие транзакциям не гарантировано
+            aligned = len(batch_results) == len(texts)
+            if not aligned:
                 print(f"[WARN] Количество результатов ({len(batch_results)}) не совпадает с количеством транзакций ({len(texts)})")
                 # Дополняем или обрезаем до нужного размера
                 if len(batch_results) < len(texts):
-                    batch_results.extend([{}] * (len(texts) - len(batch_results)))
+                    batch_results.extend([CategorizedTransaction()] * (len(texts) - len(batch_results)))
                 else:
                     batch_results = batch_results[:len(texts)]
             
-            for idx, result in enumerate(batch_results):
-                if not isinstance(result, dict):
-                    print(f"[WARN] Результат {idx} не является словарем: {type(result)}")
-                    result = {}
-                
-                category = result.get("category", "Прочее")
-                if category not in CATEGORIES:
-                    category = "Прочее"
-                
-                subcategory = result.get("subcategory", "—")
-                if category in SUBCATEGORIES:
-                    if subcategory not in SUBCATEGORIES[category]:
-                        subcategory = "—"
-                else:
-                    subcategory = "—"
-                
-                counterparty = result.get("counterparty", "—")
-                if not counterparty or counterparty.strip() == "":
-                    counterparty = "—"
-                else:
-                    counterparty = counterparty.strip()
-                
-                project = result.get("project", "—")
-                if not project or project.strip() == "":
-                    # Fallback на эвристику
-                    if idx < len(texts):
-                        project = self._extract_project(texts[idx])
-                    else:
-                        project = "—"
-                
-                validated_results.append({
-                    "category": category,
-                    "subcategory": subcategory,
-                    "counterparty": counterparty,
-                    "project": project
-                })
+            validated_results = [result.model_dump() for result in batch_results]
             
+            blank_indices = [i for i, result in enumerate(validated_results) if not result["project"]]
+            if blank_indices:
+                projects = self._extract_projects_vec(pd.Series([texts[i] for i in blank_indices], dtype=object))
+                for i, project in zip(blank_indices, projects):
+                    validated_results[i]["project"] = project
+
             if hasattr(response, "usage"):
                 token_logger.log_usage(
                     response.usage,
@@ -277,30 +567,36 @@ class TransactionAnalyzer:
                     f"batch_size={len(texts)}"
                 )
             
+            # Кэшируем только успешно разобранные и выровненные ответы, чтобы не сохранять
+            # результаты fallback и категории, сдвинутые на другие транзакции
+            if aligned:
+                # Запись в SQLite с commit() не должна задерживать параллельные батчи
+                await asyncio.to_thread(llm_cache.set_many, self.generation_model, texts, validated_results, directions)
+            
             return validated_results
             
-        except json.JSONDecodeError as e:
+        except ValidationError as e:
             print(f"[ERROR] Ошибка парсинга JSON ответа: {e}")
             print(f"[DEBUG] Ответ LLM (первые 500 символов): {response_text[:500] if 'response_text' in locals() else 'N/A'}")
             import traceback
             print(f"[DEBUG] Traceback: {traceback.format_exc()}")
             # Fallback на индивидуальную обработку
-            return self._categorize_fallback(texts)
+            return await self._categorize_fallback(texts)
         except Exception as e:
             print(f"[ERROR] Ошибка при батч-категоризации: {e}")
             import traceback
             print(f"[DEBUG] Traceback: {traceback.format_exc()}")
             # Fallback на индивидуальную обработку
-            return self._categorize_fallback(texts)
+            return await self._categorize_fallback(texts)
 
-    def _categorize_fallback(self, texts: List[str]) -> List[Dict[str, str]]:
+    async def _categorize_fallback(self, texts: List[str]) -> List[Dict[str, str]]:
         """Fallback метод: индивидуальная обработка при ошибке батча."""
         results = []
-        for text in texts:
-            category = self._get_main_category(text)
-            subcategory = self._get_subcategory(text, category)
-            counterparty = self._extract_counterparty(text)
-            project = self._extract_project(text)
+        projects = self._extract_projects_vec(pd.Series(texts, dtype=object))
+        for text, project in zip(texts, projects):
+            category = await self._get_main_category(text)
+            subcategory = await self._get_subcategory(text, category)
+            counterparty = await self._extract_counterparty(text)
             results.append({
                 "category": category,
                 "subcategory": subcategory,
@@ -309,49 +605,69 @@ class TransactionAnalyzer:
             })
         return results
 
-    def _llm_request_with_retry(self, prompt: str):
+    @staticmethod
+    def _build_messages(prompt: str, system_prompt: str) -> List[Dict]:
+        """
+        Формирует сообщения запроса: неизменяемый системный префикс идет первым,
+        чтобы провайдер мог переиспользовать его из кэша промптов.
+        """
+        if TRANSACTION_ANALYZER_CONFIG["use_prompt_cache_control"]:
+            system_content = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+        else:
+            system_content = system_prompt
+        return [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": prompt},
+        ]
+
+    @staticmethod
+    def _prompt_cache_key(system_prompt: str) -> str:
+        """Ключ кэша промпта у провайдера: хэш неизменяемого системного префикса."""
+        return "finpulse-" + hashlib.blake2b(system_prompt.encode("utf-8"), digest_size=8).hexdigest()
+
+    async def _llm_request_with_retry(self, prompt: str, system_prompt: str, response_format: Optional[Dict] = None):
         """Выполняет LLM-запрос с retry логикой и обработкой ошибок."""
+        extra_params = {"response_format": response_format} if response_format else {}
+        if TRANSACTION_ANALYZER_CONFIG["use_prompt_cache_control"]:
+            # Одинаковый ключ для одинакового системного префикса помогает провайдеру
+            # направлять запросы на узел, где этот префикс уже есть в кэше
+            extra_params["extra_body"] = {"prompt_cache_key": self._prompt_cache_key(system_prompt)}
+        messages = self._build_messages(prompt, system_prompt)
         max_retries = TRANSACTION_ANALYZER_CONFIG["max_retries"]
         retry_delay = TRANSACTION_ANALYZER_CONFIG["retry_delay"]
-        
+        retry_max_delay = TRANSACTION_ANALYZER_CONFIG["retry_max_delay"]
+
         for attempt in range(max_retries):
             try:
-                response = self.open_router_client.chat.completions.create(
+                await self.rate_limiter.acquire()
+                response = await self.open_router_client.chat.completions.create(
                     model=self.generation_model,
-                    messages=[{"role": "user", "content": prompt}],
+                    messages=messages,
                     temperature=0.0,
+                    timeout=TRANSACTION_ANALYZER_CONFIG["timeout"],
+                    **extra_params
                 )
                 return response
-            except Exception as e:
-                error_msg = str(e).lower()
-                if attempt < max_retries - 1:
-                    # Проверяем, стоит ли повторять
-                    if "rate limit" in error_msg or "timeout" in error_msg or "429" in error_msg:
-                        wait_time = retry_delay * (2 ** attempt)  # Exponential backoff
-                        print(f"[WARN] Ошибка API (попытка {attempt + 1}/{max_retries}): {e}. Повтор через {wait_time:.1f}с...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        # Для других ошибок тоже повторяем
-                        print(f"[WARN] Ошибка API (попытка {attempt + 1}/{max_retries}): {e}. Повтор...")
-                        time.sleep(retry_delay)
-                        continue
-                else:
-                    # Последняя попытка не удалась
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == max_retries - 1:
                     print(f"[ERROR] Все попытки LLM-запроса исчерпаны: {e}")
                     raise
+                # Экспоненциальная задержка с полным джиттером: параллельные батчи, упершиеся
+                # в общий лимит, не повторяют запросы одновременно
+                wait_time = random.uniform(0, min(retry_max_delay, retry_delay * (2 ** attempt)))
+                print(f"[WARN] Ошибка API (попытка {attempt + 1}/{max_retries}): {e}. Повтор через {wait_time:.1f}с...")
+                await asyncio.sleep(wait_time)
+            except Exception as e:
+                # Ошибки запроса (неверные параметры, авторизация) повтором не исправляются
+                print(f"[ERROR] LLM-запрос завершился ошибкой без повтора: {e}")
+                raise
 
-    def _get_main_category(self, text: str) -> str:
+    async def _get_main_category(self, text: str) -> str:
         """Первичная категоризация транзакции (fallback метод)."""
-        prompt = (
-            f"Ты — AI-бухгалтер. Определи главную категорию транзакции: «{text}».\n"
-            f"Категории: {', '.join(CATEGORIES)}.\n"
-            f"Если расход нельзя учесть по УСН, выбери 'Не принимаемые расходы'.\n"
-            "Ответь только одним словом — названием категории."
-        )
+        prompt = f"Транзакция: «{text}»"
 
         try:
-            response = self._llm_request_with_retry(prompt)
+            response = await self._llm_request_with_retry(prompt, MAIN_CATEGORY_SYSTEM_PROMPT)
             category = response.choices[0].message.content.strip()
             
             if hasattr(response, "usage"):
@@ -362,27 +678,21 @@ class TransactionAnalyzer:
                     f"{text=}, {category=}"
                 )
             
-            return category if category in CATEGORIES else "Прочее"
+            return category if category in CATEGORIES_SET else "Прочее"
         except Exception as e:
             print(f"[WARN] Ошибка при категоризации: {e}")
             return "Прочее"
 
-    def _get_subcategory(self, text: str, main_category: str) -> str:
+    async def _get_subcategory(self, text: str, main_category: str) -> str:
         """Детализация подкатегории на основе главной категории (fallback метод)."""
-        if main_category not in SUBCATEGORIES:
+        if main_category not in SUBCATEGORIES_SETS:
             return "—"
         
-        subcats = SUBCATEGORIES[main_category]
-        prompt = (
-            f"Ты — AI-бухгалтер. Определи подкатегорию транзакции: «{text}».\n"
-            f"Главная категория: {main_category}.\n"
-            f"Подкатегории: {', '.join(subcats)}.\n"
-            "Если подкатегорию определить невозможно, ответь '—'.\n"
-            "Ответь только одним словом или '—'."
-        )
+        subcats = SUBCATEGORIES_SETS[main_category]
+        prompt = f"Транзакция: «{text}»"
 
         try:
-            response = self._llm_request_with_retry(prompt)
+            response = await self._llm_request_with_retry(prompt, SUBCATEGORY_SYSTEM_PROMPTS[main_category])
             subcategory = response.choices[0].message.content.strip()
             
             if hasattr(response, "usage"):
@@ -398,17 +708,12 @@ class TransactionAnalyzer:
             print(f"[WARN] Ошибка при детализации: {e}")
             return "—"
 
-    def _extract_counterparty(self, text: str) -> str:
+    async def _extract_counterparty(self, text: str) -> str:
         """Извлекает наименование контрагента из назначения платежа (fallback метод)."""
-        prompt = (
-            f"Извлеки название компании или ИП из текста: «{text}».\n"
-            "Очисти от лишних слов (ООО, за, согласно, НДС, договор и т.д.).\n"
-            "Если название не найдено, ответь '—'.\n"
-            "Ответь только названием компании или '—'."
-        )
+        prompt = f"Текст: «{text}»"
 
         try:
-            response = self._llm_request_with_retry(prompt)
+            response = await self._llm_request_with_retry(prompt, COUNTERPARTY_SYSTEM_PROMPT)
             counterparty = response.choices[0].message.content.strip()
             
             if hasattr(response, "usage"):
@@ -424,17 +729,71 @@ class TransactionAnalyzer:
             print(f"[WARN] Ошибка при извлечении контрагента: {e}")
             return "—"
 
+    def _categorize_by_rules(self, texts: List[str], directions: List[int]) -> List[Optional[Dict[str, str]]]:
+        """
+        Детерминированная категоризация по ключевым словам, векторизованная через строковые методы pandas.
+        Правило применяется только к платежам своего направления: расходные категории — к списаниям,
+        поступление от клиента — к поступлениям.
+        Для текстов, к которым не подошло ни одно правило (нужен LLM), возвращает None.
+        """
+        series = pd.Series(texts, dtype=object).astype(str)
+        direction_values = np.asarray(directions)
+        categories = pd.Series(None, index=series.index, dtype=object)
+        for pattern, category, direction in CATEGORY_RULES:
+            mask = categories.isna() & (direction_values == direction) & series.str.contains(pattern, na=False)
+            categories[mask] = category
+
+        results = [None] * len(texts)
+        matched = categories.notna()
+        if not matched.any():
+            return results
+
+        matched_texts = series[matched]
+        matched_categories = categories[matched]
+
+        subcategories = pd.Series("—", index=matched_texts.index, dtype=object)
+        for category, pattern in SUBCATEGORY_PATTERNS.items():
+            in_category = matched_categories.eq(category)
+            if in_category.any():
+                found = matched_texts[in_category].str.extract(pattern, expand=False).dropna()
+                subcategories[found.index] = found.str.lower().map(SUBCATEGORY_CANONICAL)
+
+        # Без чистого наименования контрагент «—», как и в LLM-обработке
+        names = matched_texts.str.extract(COUNTERPARTY_RE)
+        counterparties = names["quoted"].fillna(names["word"]).fillna("").astype(str).str.strip()
+        counterparties = counterparties.where(counterparties.str.len() > 0, "—")
+        projects = self._extract_projects_vec(matched_texts)
+
+        for idx, category, subcategory, counterparty, project in zip(
+            matched_texts.index, matched_categories, subcategories, counterparties, projects
+        ):
+            results[idx] = {
+                "category": category,
+                "subcategory": subcategory,
+                "counterparty": counterparty,
+                "project": project
+            }
+        return results
+
     def _extract_project(self, text: str) -> str:
         """Извлекает проект/центр затрат из назначения платежа."""
         # Простая эвристика: ищем коды проектов или ключевые слова
-        project_keywords = ["Москва-Сити", "Ребрендинг", "Проект", "ЦЗ"]
-        
-        for keyword in project_keywords:
-            if keyword.lower() in text.lower():
+        for keyword, pattern in PROJECT_PATTERNS:
+            if pattern.search(text):
                 return keyword
         
         return "—"
 
+    @staticmethod
+    def _extract_projects_vec(texts: pd.Series) -> pd.Series:
+        """
+        Векторная версия _extract_project для колонки текстов: по одному проходу str.contains
+        на ключевое слово, при нескольких совпадениях выбирается первое по порядку PROJECT_KEYWORDS.
+        """
+        texts = texts.astype(str)
+        conditions = [texts.str.contains(pattern, na=False).to_numpy() for _, pattern in PROJECT_PATTERNS]
+        return pd.Series(np.select(conditions, PROJECT_KEYWORDS, default="—"), index=texts.index, dtype=object)
+
     @timed
     async def analyze_transactions(self, file, tax_mode: str = "УСН_доходы") -> Optional[Dict]:
         """
@@ -451,142 +810,100 @@ class TransactionAnalyzer:
             if "Назначение платежа" not in df.columns:
                 raise Exception("Колонка 'Назначение платежа' не найдена")
 
-            # Расширенная категоризация
-            categorization_results = self.categorize_transactions(
-                df["Назначение платежа"].tolist(),
-            )
+            # Расширенная категоризация: в выписках много повторяющихся назначений платежа,
+            # поэтому категоризируем уникальные тексты и затем раскладываем результаты по строкам по кодам factorize
+            purpose_codes, unique_purposes = pd.factorize(df["Назначение платежа"])
+            # Направление платежей по каждому назначению: правила применяются, только если все его
+            # платежи — поступления (1) или все — списания (-1)
+            valid_codes = purpose_codes >= 0
+            valid_amounts = df["Сумма"].to_numpy()[valid_codes]
+            has_incoming = np.bincount(purpose_codes[valid_codes], weights=(valid_amounts > 0).astype(np.float64),
+                                       minlength=len(unique_purposes)) > 0
+            has_outgoing = np.bincount(purpose_codes[valid_codes], weights=(valid_amounts < 0).astype(np.float64),
+                                       minlength=len(unique_purposes)) > 0
+            directions = np.where(has_incoming & ~has_outgoing, 1, np.where(has_outgoing & ~has_incoming, -1, 0))
+            categorization_results = await self.categorize_transactions(unique_purposes.tolist(), directions.tolist())
             
-            # Добавляем новые колонки
-            df["Категория"] = [r["category"] for r in categorization_results]
-            df["Подкатегория"] = [r["subcategory"] for r in categorization_results]
-            df["Контрагент"] = [r["counterparty"] for r in categorization_results]
-            df["Проект"] = [r["project"] for r in categorization_results]
-            df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce").fillna(0)
+            def column_values(field: str, default: str) -> np.ndarray:
+                # Последний элемент — значение по умолчанию для пустого назначения (код -1)
+                values = np.array([result[field] for result in categorization_results] + [default], dtype=object)
+                return values[purpose_codes]
+
+            # Добавляем новые колонки. Категория, подкатегория и контрагент сразу создаются как category:
+            # меньше памяти, сравнения и группировки идут по целочисленным кодам
+            df["Категория"] = pd.Categorical(column_values("category", "Прочее"), categories=CATEGORIES)
+            df["Подкатегория"] = pd.Categorical(column_values("subcategory", "—"))
+            df["Контрагент"] = pd.Categorical(column_values("counterparty", "—"))
+            df["Проект"] = column_values("project", "—")
+
+            # Модули сумм нужны почти каждому отчету: считаем их один раз для всего анализа
+            df["_abs_sum"] = df["Сумма"].abs()
 
             # Базовый расчет налогов
-            total_tax, tax_table = self.calculate_taxes(df, mode=tax_mode)
+            category_totals = self._aggregate_by_category(df)
+            total_tax, tax_rows = self.calculate_taxes(category_totals, mode=tax_mode)
 
-            # Подготовка детализированных транзакций с конвертацией дат в строки (для истории)
-            # Делаем это до анализа, чтобы сохранить в историю
-            detailed_df_for_history = df[[
+            # Подготовка детализированных транзакций с конвертацией дат в строки.
+            # Одна копия и один список записей используются и для истории, и для ответа API;
+            # делаем это до анализа, чтобы сохранить в историю
+            detailed_df = df[[
                 "Дата", "Назначение платежа", "Сумма", 
                 "Категория", "Подкатегория", "Контрагент", "Проект"
             ]].copy()
             
-            # Конвертируем Timestamp в строки для истории
-            if "Дата" in detailed_df_for_history.columns:
-                detailed_df_for_history["Дата"] = detailed_df_for_history["Дата"].apply(
-                    lambda x: x.strftime("%Y-%m-%d") if pd.notna(x) and hasattr(x, 'strftime') else str(x) if pd.notna(x) else ""
-                )
+            # Проверяем даты перед конвертацией
+            na_before = detailed_df["Дата"].isna().sum()
+            if na_before > 0:
+                print(f"[WARN] Перед конвертацией: {na_before} транзакций с NaN датами")
+                # Выводим примеры
+                for idx in detailed_df[detailed_df["Дата"].isna()].index[:3]:
+                    print(f"[WARN] Транзакция без даты (индекс {idx}): Категория='{detailed_df.loc[idx, 'Категория']}', Сумма={detailed_df.loc[idx, 'Сумма']}")
+            
+            # Конвертируем Timestamp в строки для JSON сериализации
+            detailed_df["Дата"] = self._format_dates(detailed_df["Дата"])
+            
+            # Проверяем, что даты не потерялись
+            empty_dates = detailed_df["Дата"].eq("").sum()
+            if empty_dates > 0:
+                print(f"[WARN] {empty_dates} транзакций с пустыми датами после конвертации")
+            
+            detailed_df["Сумма"] = detailed_df["Сумма"].astype(np.float64).fillna(0.0)
+            detailed_transactions = self._to_records(detailed_df)
             
             # Сохраняем транзакции в историю
-            detailed_transactions_for_history = detailed_df_for_history.to_dict(orient="records")
             transaction_history.save_transactions(
-                detailed_transactions_for_history,
+                detailed_transactions,
                 metadata={"tax_mode": tax_mode, "filename": file.filename}
             )
 
+            # Историческая статистика по категориям читается одним проходом по истории
+            # и используется и анализом аномалий, и прогнозами
+            hist_by_category = transaction_history.get_category_statistics_bulk(
+                [*category_totals.index, "Реклама", "Аренда", "Поступление от клиента"], days_back=90
+            )
+
             # Анализ аномалий (с учетом истории)
-            anomalies = self._detect_anomalies(df)
+            anomalies = self._detect_anomalies(df, category_totals, hist_by_category)
 
             # Управленческий P&L
-            pl_report = self._generate_pl_report(df)
+            pl_report = self._generate_pl_report(df, category_totals)
             
             # Вычисляем общие доходы и расходы для summary
-            total_income = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
-            total_expenses = df[df["Категория"] != "Поступление от клиента"]["Сумма"].abs().sum()
+            total_income, total_expenses = self._income_and_expenses(category_totals)
 
             # Прогнозы и рекомендации (с учетом сезонности и истории)
-            forecasts = self._generate_forecasts(df)
+            forecasts = self._generate_forecasts(df, pl_report, total_income, total_expenses, hist_by_category)
 
-            # Подготовка детализированных транзакций с конвертацией дат в строки
-            detailed_df = df[[
-                "Дата", "Назначение платежа", "Сумма", 
-                "Категория", "Подкатегория", "Контрагент", "Проект"
-            ]].copy()
-            
-            # Проверяем даты перед конвертацией
-            na_before = detailed_df["Дата"].isna().sum()
-            if na_before > 0:
-                print(f"[WARN] Перед конвертацией: {na_before} транзакций с NaN датами")
-                # Выводим примеры
-                for idx in detailed_df[detailed_df["Дата"].isna()].index[:3]:
-                    print(f"[WARN] Транзакция без даты (индекс {idx}): Категория='{detailed_df.loc[idx, 'Категория']}', Сумма={detailed_df.loc[idx, 'Сумма']}")
-            
-            # Конвертируем Timestamp в строки для JSON сериализации
-            if "Дата" in detailed_df.columns:
-                def convert_date(x):
-                    if pd.isna(x):
-                        return ""
-                    # Если это Timestamp или datetime объект
-                    if hasattr(x, 'strftime'):
-                        try:
-                            return x.strftime("%Y-%m-%d")
-                        except:
-                            return str(x)
-                    # Если это уже строка
-                    if isinstance(x, str):
-                        # Пытаемся распарсить и вернуть в нужном формате
-                        try:
-                            parsed = pd.to_datetime(x, errors="coerce")
-                            if pd.notna(parsed):
-                                return parsed.strftime("%Y-%m-%d")
-                            return x  # Возвращаем исходную строку, если не удалось распарсить
-                        except:
-                            return x
-                    return str(x) if x else ""
-                
-                detailed_df["Дата"] = detailed_df["Дата"].apply(convert_date)
-                
-                # Проверяем, что даты не потерялись
-                empty_dates = detailed_df["Дата"].eq("").sum()
-                if empty_dates > 0:
-                    print(f"[WARN] {empty_dates} транзакций с пустыми датами после конвертации")
-                    # Пытаемся восстановить из исходного DataFrame
-                    # Используем reset_index для сохранения исходных индексов
-                    detailed_df_reset = detailed_df.reset_index()
-                    df_reset = df.reset_index()
-                    
-                    for idx in detailed_df[detailed_df["Дата"] == ""].index:
-                        # Находим соответствующую строку в исходном DataFrame
-                        # Индексы должны совпадать, так как мы делали copy() без изменений порядка
-                        if idx in df.index:
-                            original_date = df.loc[idx, "Дата"]
-                            if pd.notna(original_date):
-                                try:
-                                    if hasattr(original_date, 'strftime'):
-                                        detailed_df.loc[idx, "Дата"] = original_date.strftime("%Y-%m-%d")
-                                    else:
-                                        # Пробуем распарсить строку
-                                        parsed = pd.to_datetime(str(original_date), errors="coerce")
-                                        if pd.notna(parsed):
-                                            detailed_df.loc[idx, "Дата"] = parsed.strftime("%Y-%m-%d")
-                                        else:
-                                            detailed_df.loc[idx, "Дата"] = str(original_date)
-                                except Exception as e:
-                                    print(f"[WARN] Ошибка при восстановлении даты для индекса {idx}: {e}")
-                                    detailed_df.loc[idx, "Дата"] = str(original_date) if original_date else ""
-                    
-                    # Проверяем результат
-                    empty_after = detailed_df["Дата"].eq("").sum()
-                    if empty_after < empty_dates:
-                        print(f"[INFO] Восстановлено {empty_dates - empty_after} дат")
-                    if empty_after > 0:
-                        print(f"[WARN] Осталось {empty_after} транзакций с пустыми датами")
-            
-            # Конвертируем все числовые типы в нативные Python типы
-            detailed_df["Сумма"] = detailed_df["Сумма"].apply(lambda x: float(x) if pd.notna(x) else 0.0)
-            
             # Сравнение периодов (для bar chart)
             period_comparison = None
             if "Дата" in df.columns and not df["Дата"].isna().all():
                 try:
-                    dates = pd.to_datetime(df["Дата"], errors="coerce").dropna()
+                    dates = df["Дата"].dropna()
                     if len(dates) > 0:
                         current_start = dates.min().to_pydatetime()
                         current_end = dates.max().to_pydatetime()
                         # Передаем транзакции из текущего файла для точного расчета
-                        current_tx_list = detailed_df.to_dict(orient="records")
+                        current_tx_list = detailed_transactions
                         period_comparison = transaction_history.get_period_comparison(
                             current_start, current_end, current_transactions_list=current_tx_list
                         )
@@ -594,10 +911,10 @@ class TransactionAnalyzer:
                     print(f"[WARN] Ошибка при расчете сравнения периодов: {e}")
             
             # Бенчмаркинг
-            benchmarking = self._calculate_benchmarking(pl_report, df)
+            benchmarking = self._calculate_benchmarking(pl_report, category_totals)
             
             # Налоговое планирование
-            tax_planning = self._generate_tax_planning(df, tax_mode, total_tax, forecasts)
+            tax_planning = self._generate_tax_planning(total_income, total_expenses, tax_mode, total_tax, forecasts)
             
             return {
                 "summary": {
@@ -607,8 +924,8 @@ class TransactionAnalyzer:
                     "income": float(total_income),
                     "expenses": float(total_expenses)
                 },
-                "transactions": tax_table.to_dict(orient="records"),
-                "detailed_transactions": detailed_df.to_dict(orient="records"),
+                "transactions": [{"Показатель": name, "Значение": value} for name, value in tax_rows],
+                "detailed_transactions": detailed_transactions,
                 "anomalies": anomalies,
                 "pl_report": pl_report,
                 "forecasts": forecasts,
@@ -621,109 +938,177 @@ class TransactionAnalyzer:
             print(f"[ERROR] Ошибка при обработке файла: {e}")
             raise
 
-    def _detect_anomalies(self, df: pd.DataFrame) -> List[Dict]:
-        """Обнаружение аномалий в транзакциях."""
+    @staticmethod
+    def _to_records(df: pd.DataFrame) -> List[Dict]:
+        """
+        Преобразует DataFrame в список словарей с нативными типами Python (как to_dict(orient="records")).
+        Каждая колонка один раз выгружается через tolist, строки собираются zip — без построчного боксинга pandas.
+        """
+        columns = list(df.columns)
+        return [dict(zip(columns, row)) for row in zip(*(df[column].tolist() for column in columns))]
+
+    @staticmethod
+    def _format_dates(dates: pd.Series) -> pd.Series:
+        """Векторно форматирует даты (datetime64) в строки YYYY-MM-DD; пустые даты становятся пустой строкой."""
+        return dates.dt.strftime("%Y-%m-%d").fillna("")
+
+    @staticmethod
+    def _group_mean_std(values: np.ndarray, codes: np.ndarray, n_groups: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Количество, среднее и выборочное стандартное отклонение (ddof=1) значений по группам.
+        Значения один раз сортируются по коду группы, затем каждая группа — непрерывный срез массива,
+        поэтому суммы считаются той же попарной суммацией NumPy, что и в Series.mean/std.
+        """
+        counts = np.bincount(codes, minlength=n_groups)
+        mean = np.full(n_groups, np.nan)
+        std = np.full(n_groups, np.nan)
+        sorted_values = values[np.argsort(codes, kind="stable")]
+        start = 0
+        for code, count in enumerate(counts):
+            group = sorted_values[start:start + count]
+            start += count
+            if count == 0:
+                continue
+            mean[code] = group.sum() / count
+            if count > 1:
+                std[code] = np.sqrt(((mean[code] - group) ** 2).sum() / (count - 1))
+        return counts, mean, std
+
+    @staticmethod
+    def _outlier_mask(values: np.ndarray, codes: np.ndarray, counts: np.ndarray,
+                      mean: np.ndarray, std: np.ndarray, sigma: float) -> np.ndarray:
+        """Маска значений, превышающих среднее своей группы более чем на sigma стандартных отклонений."""
+        group_std = std[codes]
+        with np.errstate(invalid="ignore"):
+            return (counts[codes] >= 3) & (group_std > 0) & (values > mean[codes] + sigma * group_std)
+
+    def _detect_anomalies(self, df: pd.DataFrame, category_totals: pd.DataFrame, hist_by_category: Dict[str, Dict]) -> List[Dict]:
+        """
+        Обнаружение аномалий в транзакциях. Суммы по категориям берутся из готовых агрегатов,
+        историческая статистика по категориям — из hist_by_category.
+        """
         anomalies = []
-        df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce").fillna(0)
-        
-        # Логирование для отладки
-        print(f"[DEBUG] Обнаружение аномалий: всего транзакций {len(df)}, категорий {len(df['Категория'].unique())}")
+        # Логирование для отладки: сообщения (и их форматирование) только при включенном флаге
+        if LOGGING_ANALYSIS_DEBUG:
+            print(f"[DEBUG] Обнаружение аномалий: всего транзакций {len(df)}, категорий {len(df['Категория'].unique())}")
         
         # Проверяем, что есть данные для анализа
         if len(df) == 0:
-            print("[DEBUG] Нет транзакций для анализа аномалий")
+            if LOGGING_ANALYSIS_DEBUG:
+                print("[DEBUG] Нет транзакций для анализа аномалий")
             return []
 
         # 1. Всплеск расходов (outliers)
+        # Статистика по абсолютным суммам считается для всех категорий сразу на массивах NumPy,
+        # в результат попадают оригинальные суммы
         sigma_threshold = TRANSACTION_ANALYZER_CONFIG["outlier_sigma_threshold"]
-        for category in df["Категория"].unique():
-            category_df = df[df["Категория"] == category].copy()
-            if len(category_df) < 3:
-                print(f"[DEBUG] Категория '{category}': пропущена (транзакций < 3: {len(category_df)})")
-                continue
-            
-            # Используем абсолютные значения для статистики, но сохраняем оригинальные для фильтрации
-            amounts_abs = category_df["Сумма"].abs()
-            mean = amounts_abs.mean()
-            std = amounts_abs.std()
-            
-            if std > 0:
-                # Фильтруем по абсолютным значениям, но используем оригинальные суммы в результате
-                outlier_mask = amounts_abs > mean + sigma_threshold * std
-                outliers = category_df[outlier_mask]
-                
-                for _, row in outliers.iterrows():
-                    amount_abs = abs(row["Сумма"])
-                    deviation_sigma = ((amount_abs - mean) / std) if std > 0 else 0
-                    anomalies.append({
-                        "type": "Всплеск расходов",
-                        "severity": "high",
-                        "description": f"Транзакция {amount_abs:.2f} ₽ в категории '{category}' превышает средний чек ({mean:.2f} ₽) более чем в {sigma_threshold} раза (отклонение: {deviation_sigma:.2f}σ)",
-                        "transaction": {
-                            "date": str(row.get("Дата", "")),
-                            "amount": float(row["Сумма"]),
-                            "description": str(row.get("Назначение платежа", ""))
-                        }
-                    })
+        amounts_abs = np.abs(df["Сумма"].to_numpy(dtype=np.float64))
+        # Коды категорий в порядке первого появления
+        category_codes, category_names = pd.factorize(df["Категория"])
+        counts, mean, std = self._group_mean_std(amounts_abs, category_codes, len(category_names))
+        if LOGGING_ANALYSIS_DEBUG:
+            for code in np.flatnonzero(counts < 3):
+                print(f"[DEBUG] Категория '{category_names[code]}': пропущена (транзакций < 3: {counts[code]})")
+
+        outlier_mask = self._outlier_mask(amounts_abs, category_codes, counts, mean, std, sigma_threshold)
+
+        if outlier_mask.any():
+            # Порядок как при обходе категорий: по первому появлению категории, внутри — по строкам.
+            # Поля выбросов собираются столбцами (массивы NumPy и tolist), без построчного обхода DataFrame
+            outlier_rows = np.flatnonzero(outlier_mask)
+            outlier_rows = outlier_rows[np.argsort(category_codes[outlier_rows], kind="stable")]
+            outlier_codes = category_codes[outlier_rows]
+            outlier_abs = amounts_abs[outlier_rows]
+            outlier_mean = mean[outlier_codes]
+            deviation_sigma = (outlier_abs - outlier_mean) / std[outlier_codes]
+
+            for category, amount_abs, category_mean, sigma, date, amount, description in zip(
+                category_names[outlier_codes].tolist(),
+                outlier_abs.tolist(),
+                outlier_mean.tolist(),
+                deviation_sigma.tolist(),
+                df["Дата"].iloc[outlier_rows].tolist(),
+                df["Сумма"].iloc[outlier_rows].tolist(),
+                df["Назначение платежа"].iloc[outlier_rows].tolist(),
+            ):
+                anomalies.append({
+                    "type": "Всплеск расходов",
+                    "severity": "high",
+                    "description": f"Транзакция {amount_abs:.2f} ₽ в категории '{category}' превышает средний чек ({category_mean:.2f} ₽) более чем в {sigma_threshold} раза (отклонение: {sigma:.2f}σ)",
+                    "transaction": {
+                        "date": str(date),
+                        "amount": float(amount),
+                        "description": str(description)
+                    }
+                })
+                if LOGGING_ANALYSIS_DEBUG:
                     print(f"[DEBUG] Найдена аномалия: всплеск расходов в категории '{category}', сумма {amount_abs:.2f} ₽")
 
         # 2. Новые контрагенты (с учетом истории)
         known_counterparties = transaction_history.get_known_counterparties(days_back=90)
-        current_counterparties = set(df[df["Контрагент"] != "—"]["Контрагент"].unique())
-        new_counterparties = current_counterparties - known_counterparties
-        
+        # Категории колонки «Контрагент» — уже уникальные значения, строки по ним не перебираем
+        new_counterparties = set(df["Контрагент"].cat.categories) - known_counterparties - {"—"}
+
+        # Суммы по контрагентам считаются одним проходом groupby и только если есть новые контрагенты
         counterparty_threshold = TRANSACTION_ANALYZER_CONFIG["new_counterparty_threshold"]
-        for counterparty in new_counterparties:
-            counterparty_df = df[df["Контрагент"] == counterparty]
-            total = counterparty_df["Сумма"].abs().sum()
-            if total > counterparty_threshold:
-                anomalies.append({
+        if new_counterparties:
+            counterparty_totals = df["_abs_sum"].groupby(df["Контрагент"], sort=False, observed=True).sum()
+            new_mask = counterparty_totals.index.isin(new_counterparties) & (counterparty_totals.to_numpy() > counterparty_threshold)
+            new_counterparty_totals = counterparty_totals[new_mask]
+            # Записи собираются одним списковым выражением по колонкам (tolist), без построчного обхода Series
+            anomalies.extend(
+                {
                     "type": "Новый контрагент",
                     "severity": "medium",
                     "description": f"Платеж новому контрагенту '{counterparty}' на сумму {total:.2f} ₽. Контрагент не встречался в истории за последние 90 дней. Рекомендуется проверить договор.",
                     "transaction": {
                         "counterparty": counterparty,
-                        "total": float(total)
+                        "total": total
                     }
-                })
-                print(f"[DEBUG] Найдена аномалия: новый контрагент '{counterparty}', сумма {total:.2f} ₽")
-        
+                }
+                for counterparty, total in zip(new_counterparty_totals.index.tolist(), new_counterparty_totals.tolist())
+            )
+            if LOGGING_ANALYSIS_DEBUG:
+                for counterparty, total in new_counterparty_totals.items():
+                    print(f"[DEBUG] Найдена аномалия: новый контрагент '{counterparty}', сумма {total:.2f} ₽")
+
         # 2.1. Сравнение с историческими данными для категорий (только если есть достаточно истории)
         # Используем историю только как дополнительный контекст, не блокируем обнаружение аномалий
-        for category in df["Категория"].unique():
-            category_df = df[df["Категория"] == category]
-            if len(category_df) < 3:
-                continue
-            
-            # Получаем историческую статистику (исключая текущий файл - берем данные до сегодня)
-            hist_stats = transaction_history.get_category_statistics(category, days_back=90)
-            
-            # Проверяем только если есть достаточно исторических данных (минимум 10 транзакций)
-            if hist_stats["count"] >= 10:
-                current_total = category_df["Сумма"].abs().sum()
-                current_mean = category_df["Сумма"].abs().mean()
-                hist_mean = hist_stats["mean"]
-                
-                # Проверяем значительное отклонение от исторического среднего
-                if hist_mean > 0:
-                    deviation = abs(current_mean - hist_mean) / hist_mean
-                    if deviation > 0.3:  # Отклонение более 30%
-                        anomalies.append({
-                            "type": "Отклонение от тренда",
-                            "severity": "medium",
-                            "description": f"Категория '{category}': средний чек {current_mean:.2f} ₽ отличается от исторического ({hist_mean:.2f} ₽) на {deviation*100:.1f}%",
-                            "transaction": {
-                                "category": category,
-                                "current_mean": float(current_mean),
-                                "historical_mean": float(hist_mean),
-                                "deviation": float(deviation)
-                            }
-                        })
-                        print(f"[DEBUG] Найдена аномалия: отклонение от тренда в категории '{category}'")
+        # Средний чек по категориям — из агрегатов, историческая статистика — из общей выборки анализа
+        category_stats = category_totals[category_totals["count"] >= 3]
+        current_means = (category_stats["abs_sum"] / category_stats["count"]).to_numpy()
+        trend_categories = category_stats.index.tolist()
+        # Историческая статистика (исключая текущий файл - берем данные до сегодня)
+        hist_counts = np.array([hist_by_category[category]["count"] for category in trend_categories], dtype=np.int64)
+        hist_means = np.array([hist_by_category[category]["mean"] for category in trend_categories], dtype=np.float64)
+        # Проверяем только если есть достаточно исторических данных (минимум 10 транзакций) и средний чек > 0
+        has_history = (hist_counts >= 10) & (hist_means > 0)
+        deviations = np.zeros_like(current_means)
+        np.divide(np.abs(current_means - hist_means), hist_means, out=deviations, where=has_history)
+        trend_mask = has_history & (deviations > 0.3)  # Отклонение более 30%
+        for category, current_mean, hist_mean, deviation in zip(
+            category_stats.index[trend_mask].tolist(),
+            current_means[trend_mask].tolist(),
+            hist_means[trend_mask].tolist(),
+            deviations[trend_mask].tolist(),
+        ):
+            anomalies.append({
+                "type": "Отклонение от тренда",
+                "severity": "medium",
+                "description": f"Категория '{category}': средний чек {current_mean:.2f} ₽ отличается от исторического ({hist_mean:.2f} ₽) на {deviation*100:.1f}%",
+                "transaction": {
+                    "category": category,
+                    "current_mean": current_mean,
+                    "historical_mean": hist_mean,
+                    "deviation": deviation
+                }
+            })
+            if LOGGING_ANALYSIS_DEBUG:
+                print(f"[DEBUG] Найдена аномалия: отклонение от тренда в категории '{category}'")
 
         # 3. Негативная динамика (улучшенный расчет CAC)
-        income = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
-        advertising = df[df["Категория"] == "Реклама"]["Сумма"].abs().sum()
+        income = category_totals["sum"].get("Поступление от клиента", 0.0)
+        advertising = category_totals["abs_sum"].get("Реклама", 0.0)
         
         if income > 0 and advertising > 0:
             # Улучшенный расчет CAC: реклама / количество уникальных клиентов (приблизительно)
@@ -734,8 +1119,8 @@ class TransactionAnalyzer:
             cac = advertising / estimated_customers if estimated_customers > 0 else 0
             
             # Сравниваем с историческим CAC
-            hist_adv_stats = transaction_history.get_category_statistics("Реклама", days_back=90)
-            hist_income_stats = transaction_history.get_category_statistics("Поступление от клиента", days_back=90)
+            hist_adv_stats = hist_by_category["Реклама"]
+            hist_income_stats = hist_by_category["Поступление от клиента"]
             
             if hist_adv_stats["count"] > 0 and hist_income_stats["count"] > 0:
                 hist_estimated_customers = max(1, hist_income_stats["total"] / avg_customer_value)
@@ -766,42 +1151,42 @@ class TransactionAnalyzer:
                     }
                 })
 
-        print(f"[DEBUG] Всего обнаружено аномалий: {len(anomalies)}")
+        if LOGGING_ANALYSIS_DEBUG:
+            print(f"[DEBUG] Всего обнаружено аномалий: {len(anomalies)}")
         return anomalies
 
-    def _generate_pl_report(self, df: pd.DataFrame) -> Dict:
-        """Генерация управленческого P&L отчета."""
-        df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce").fillna(0)
-        
+    def _generate_pl_report(self, df: pd.DataFrame, category_totals: pd.DataFrame) -> Dict:
+        """Генерация управленческого P&L отчета. Суммы по категориям берутся из готовых агрегатов."""
         # Выручка
-        revenue = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
+        revenue = category_totals["sum"].get("Поступление от клиента", 0.0)
         
         # COGS (Себестоимость)
-        cogs_categories = df[
-            (df["Категория"] == "Закупка товара") & 
-            (df["Подкатегория"].isin(["Сырье", "Комплектующие"]))
-        ]
-        cogs = cogs_categories["Сумма"].abs().sum()
+        # Маска строится сравнением целочисленных кодов категорий, без сравнения строк
+        category_code = df["Категория"].cat.categories.get_loc("Закупка товара")
+        subcategory_codes = df["Подкатегория"].cat.categories.get_indexer(["Сырье", "Комплектующие"])
+        cogs_mask = (df["Категория"].cat.codes.to_numpy() == category_code) & np.isin(
+            df["Подкатегория"].cat.codes.to_numpy(), subcategory_codes[subcategory_codes >= 0]
+        )
+        cogs = df.loc[cogs_mask, "_abs_sum"].sum()
         
         # Валовая прибыль
         gross_profit = revenue - cogs
         
         # Операционные расходы (все расходы кроме COGS и "Не принимаемые расходы")
         # COGS уже учтен отдельно, поэтому вычитаем его из операционных расходов
-        all_expenses = df[
-            ~df["Категория"].isin(["Поступление от клиента", "Не принимаемые расходы"])
-        ]["Сумма"].abs().sum()
+        all_expenses = category_totals["abs_sum"].drop(
+            ["Поступление от клиента", "Не принимаемые расходы"], errors="ignore"
+        ).sum()
         operating_expenses = all_expenses - cogs  # Исключаем COGS из операционных расходов
         
         # Операционная прибыль (EBITDA)
         operating_profit = gross_profit - operating_expenses
         
         # Детализация по категориям
-        expense_breakdown = {}
-        for category in df[df["Категория"] != "Поступление от клиента"]["Категория"].unique():
-            expense_breakdown[category] = float(
-                df[df["Категория"] == category]["Сумма"].abs().sum()
-            )
+        expense_breakdown = {
+            category: float(abs_sum)
+            for category, abs_sum in category_totals["abs_sum"].drop("Поступление от клиента", errors="ignore").items()
+        }
 
         return {
             "revenue": float(revenue),
@@ -814,27 +1199,43 @@ class TransactionAnalyzer:
             "expense_breakdown": expense_breakdown
         }
 
-    def _generate_forecasts(self, df: pd.DataFrame) -> Dict:
+    @staticmethod
+    def _seasonal_factors(monthly_avgs: List[Dict[str, float]], month_key: str) -> List[float]:
+        """
+        Сезонные коэффициенты: среднее за текущий месяц к среднему по всем месяцам.
+        Без данных за текущий месяц коэффициент равен 1.0; все коэффициенты ограничиваются
+        разумными пределами (0.5 - 2.0) одним вызовом np.clip.
+        """
+        # Истории за текущий месяц нет ни по одной категории — считать нечего
+        if not any(month_key in monthly_avg for monthly_avg in monthly_avgs):
+            return [1.0] * len(monthly_avgs)
+        factors = np.ones(len(monthly_avgs))
+        for i, monthly_avg in enumerate(monthly_avgs):
+            if month_key in monthly_avg:
+                avg_all_months = fmean(monthly_avg.values())
+                if avg_all_months > 0:
+                    factors[i] = monthly_avg[month_key] / avg_all_months
+        return np.clip(factors, 0.5, 2.0).tolist()
+
+    def _generate_forecasts(self, df: pd.DataFrame, pl_report: Dict, total_income: float, total_expenses: float,
+                            hist_by_category: Dict[str, Dict]) -> Dict:
         """
         Генерация прогнозов и рекомендаций с учетом сезонности и истории.
         Включает confidence intervals для более точных прогнозов.
+        Расходы по категориям берутся из P&L отчета, общие доходы и расходы считаются один раз в analyze_transactions;
+        hist_by_category — историческая статистика по категориям за 90 дней.
         """
-        df["Сумма"] = pd.to_numeric(df["Сумма"], errors="coerce").fillna(0)
-        
         # Определяем регулярные платежи (аренда, зарплата, подписки)
         regular_categories = ["Аренда", "Зарплата"]
-        regular_payments = df[df["Категория"].isin(regular_categories)]["Сумма"].abs().sum()
-        
-        # Текущие расходы и доходы
-        total_expenses = df[df["Категория"] != "Поступление от клиента"]["Сумма"].abs().sum()
-        total_income = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
+        expense_breakdown = pl_report["expense_breakdown"]
+        regular_payments = sum(expense_breakdown.get(category, 0.0) for category in regular_categories)
         
         # Определяем период данных (в днях)
         num_transactions = len(df)
         if "Дата" in df.columns and not df["Дата"].isna().all():
             try:
-                dates = pd.to_datetime(df["Дата"], errors="coerce")
-                dates = dates.dropna()
+                # Даты уже разобраны в parse_transactions
+                dates = df["Дата"].dropna()
                 if len(dates) > 1:
                     period_days = (dates.max() - dates.min()).days + 1
                 elif len(dates) == 1:
@@ -869,8 +1270,8 @@ class TransactionAnalyzer:
             
             # Получаем исторические данные для более точного прогноза (только если достаточно данных)
             if use_history:
-                hist_expenses_stats = transaction_history.get_category_statistics("Аренда", days_back=90)
-                hist_income_stats = transaction_history.get_category_statistics("Поступление от клиента", days_back=90)
+                hist_expenses_stats = hist_by_category["Аренда"]
+                hist_income_stats = hist_by_category["Поступление от клиента"]
             else:
                 hist_expenses_stats = {"count": 0, "std": 0}
                 hist_income_stats = {"count": 0, "std": 0}
@@ -880,38 +1281,25 @@ class TransactionAnalyzer:
             seasonal_factor_income = 1.0
             
             if use_history:
-                current_month = datetime.now().month
-                seasonal_patterns_expenses = transaction_history.get_seasonal_patterns("Аренда", days_back=365)
-                seasonal_patterns_income = transaction_history.get_seasonal_patterns("Поступление от клиента", days_back=365)
-                
-                if seasonal_patterns_expenses["monthly_avg"]:
-                    current_month_key = str(current_month).zfill(2)
-                    if current_month_key in seasonal_patterns_expenses["monthly_avg"]:
-                        avg_all_months = sum(seasonal_patterns_expenses["monthly_avg"].values()) / len(seasonal_patterns_expenses["monthly_avg"])
-                        if avg_all_months > 0:
-                            seasonal_factor_expenses = seasonal_patterns_expenses["monthly_avg"][current_month_key] / avg_all_months
-                            # Ограничиваем сезонный коэффициент разумными пределами (0.5 - 2.0)
-                            seasonal_factor_expenses = max(0.5, min(2.0, seasonal_factor_expenses))
-                
-                if seasonal_patterns_income["monthly_avg"]:
-                    current_month_key = str(current_month).zfill(2)
-                    if current_month_key in seasonal_patterns_income["monthly_avg"]:
-                        avg_all_months = sum(seasonal_patterns_income["monthly_avg"].values()) / len(seasonal_patterns_income["monthly_avg"])
-                        if avg_all_months > 0:
-                            seasonal_factor_income = seasonal_patterns_income["monthly_avg"][current_month_key] / avg_all_months
-                            # Ограничиваем сезонный коэффициент разумными пределами (0.5 - 2.0)
-                            seasonal_factor_income = max(0.5, min(2.0, seasonal_factor_income))
+                seasonal_patterns = transaction_history.get_seasonal_patterns_bulk(
+                    ["Аренда", "Поступление от клиента"], days_back=365
+                )
+                seasonal_factor_expenses, seasonal_factor_income = self._seasonal_factors(
+                    [seasonal_patterns["Аренда"]["monthly_avg"], seasonal_patterns["Поступление от клиента"]["monthly_avg"]],
+                    f"{datetime.now().month:02d}",
+                )
             
             # Прогноз на 30 дней с учетом сезонности
             forecast_30d_expenses = avg_daily_expenses * 30 * seasonal_factor_expenses
             forecast_30d_income = avg_daily_income * 30 * seasonal_factor_income
         
         # Логирование для отладки
-        print(f"[FORECAST] Транзакций: {num_transactions}, Период: {period_days} дней")
-        print(f"[FORECAST] Расходы: {total_expenses:.2f} ₽, Доходы: {total_income:.2f} ₽")
-        print(f"[FORECAST] Средние дневные: расходы {avg_daily_expenses:.2f} ₽/день, доходы {avg_daily_income:.2f} ₽/день")
-        print(f"[FORECAST] Сезонные коэффициенты: расходы {seasonal_factor_expenses:.2f}x, доходы {seasonal_factor_income:.2f}x")
-        print(f"[FORECAST] Прогноз на 30 дней: расходы {forecast_30d_expenses:.2f} ₽, доходы {forecast_30d_income:.2f} ₽")
+        if LOGGING_ANALYSIS_DEBUG:
+            print(f"[FORECAST] Транзакций: {num_transactions}, Период: {period_days} дней")
+            print(f"[FORECAST] Расходы: {total_expenses:.2f} ₽, Доходы: {total_income:.2f} ₽")
+            print(f"[FORECAST] Средние дневные: расходы {avg_daily_expenses:.2f} ₽/день, доходы {avg_daily_income:.2f} ₽/день")
+            print(f"[FORECAST] Сезонные коэффициенты: расходы {seasonal_factor_expenses:.2f}x, доходы {seasonal_factor_income:.2f}x")
+            print(f"[FORECAST] Прогноз на 30 дней: расходы {forecast_30d_expenses:.2f} ₽, доходы {forecast_30d_income:.2f} ₽")
         
         # Confidence intervals (95% доверительный интервал)
         # Используем стандартное отклонение из истории, если доступно
@@ -940,15 +1328,9 @@ class TransactionAnalyzer:
         # Рекомендации с конкретными действиями
         recommendations = []
         
-        # Анализ расходов по категориям для конкретных рекомендаций
-        expense_breakdown = {}
-        for category in df[df["Категория"] != "Поступление от клиента"]["Категория"].unique():
-            expense_breakdown[category] = float(
-                df[df["Категория"] == category]["Сумма"].abs().sum()
-            )
-        
+        # Анализ расходов по категориям для конкретных рекомендаций (детализация из P&L отчета)
         # Топ-3 категории расходов
-        top_expenses = sorted(expense_breakdown.items(), key=lambda x: x[1], reverse=True)[:3]
+        top_expenses = heapq.nlargest(3, expense_breakdown.items(), key=lambda item: item[1])
         
         # Конкретные рекомендации по оптимизации
         if top_expenses:
@@ -962,8 +1344,8 @@ class TransactionAnalyzer:
                     })
         
         # Рекомендация по налоговому режиму
-        income = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
-        expenses = df[df["Категория"] != "Поступление от клиента"]["Сумма"].abs().sum()
+        income = total_income
+        expenses = total_expenses
         if income > 0 and expenses > 0:
             tax_income_mode = income * 0.06
             tax_expenses_mode = max((income - expenses) * 0.15, 0)
@@ -1011,7 +1393,7 @@ class TransactionAnalyzer:
                 })
         
         # Приоритизация рекомендаций (критические первыми)
-        recommendations.sort(key=lambda x: {"critical": 0, "warning": 1, "info": 2}.get(x["type"], 3))
+        recommendations.sort(key=lambda x: RECOMMENDATION_PRIORITY.get(x["type"], 3))
 
         return {
             "avg_daily_expenses": float(avg_daily_expenses),
@@ -1040,7 +1422,7 @@ class TransactionAnalyzer:
             "recommendations": recommendations
         }
     
-    def _calculate_benchmarking(self, pl_report: Dict, df: pd.DataFrame) -> Dict:
+    def _calculate_benchmarking(self, pl_report: Dict, category_totals: pd.DataFrame) -> Dict:
         """
         Сравнение с индустриальными бенчмарками.
         Использует типичные значения для малого и среднего бизнеса в России.
@@ -1065,15 +1447,15 @@ class TransactionAnalyzer:
         
         # Текущие показатели
         current_cac_ratio = 0
-        advertising = df[df["Категория"] == "Реклама"]["Сумма"].abs().sum()
+        advertising = category_totals["abs_sum"].get("Реклама", 0.0)
         if revenue > 0:
             current_cac_ratio = advertising / revenue
         
         current_gross_margin = pl_report.get("gross_margin", 0)
         current_operating_margin = pl_report.get("operating_margin", 0)
         
-        salary = df[df["Категория"] == "Зарплата"]["Сумма"].abs().sum()
-        rent = df[df["Категория"] == "Аренда"]["Сумма"].abs().sum()
+        salary = category_totals["abs_sum"].get("Зарплата", 0.0)
+        rent = category_totals["abs_sum"].get("Аренда", 0.0)
         
         current_salary_ratio = salary / revenue if revenue > 0 else 0
         current_rent_ratio = rent / revenue if revenue > 0 else 0
@@ -1147,12 +1529,11 @@ class TransactionAnalyzer:
             }
         }
     
-    def _generate_tax_planning(self, df: pd.DataFrame, current_mode: str, current_tax: float, forecasts: Dict) -> Dict:
+    def _generate_tax_planning(self, revenue: float, expenses: float, current_mode: str, current_tax: float, forecasts: Dict) -> Dict:
         """
         Генерация налогового планирования на год с рекомендациями.
+        revenue и expenses — доходы и расходы за период, посчитанные в analyze_transactions.
         """
-        revenue = df[df["Категория"] == "Поступление от клиента"]["Сумма"].sum()
-        expenses = df[df["Категория"] != "Поступление от клиента"]["Сумма"].abs().sum()
         
         if revenue == 0:
             return {
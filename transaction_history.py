@@ -2,19 +2,77 @@
 Модуль для хранения и анализа истории транзакций.
 Позволяет сравнивать текущие данные с предыдущими периодами.
 """
+import copy
 import json
 import os
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from typing import Any, Callable, List, Dict, Optional, Tuple
 from collections import defaultdict
+import struct
+import numpy as np
 import pandas as pd
 
+# Быстрый разбор и сериализация JSON (опционально)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Межпроцессная блокировка файла истории при дозаписи (только POSIX)
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# orjson.loads принимает bytes и str, ошибки разбора — подкласс json.JSONDecodeError
+_json_loads = orjson.loads if ORJSON_AVAILABLE else json.loads
+
+# Размер блока при чтении файла истории (байты)
+HISTORY_READ_CHUNK_SIZE = 128 * 1024
+# Размер буфера дозаписи: при его заполнении накопленные записи сбрасываются в файл истории (байты)
+HISTORY_WRITE_BUFFER_SIZE = 64 * 1024
+
+# Запись индекса истории: смещение строки в файле (байты) и время записи (микросекунды)
+INDEX_RECORD = struct.Struct("<Qq")
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("ts", "<i8")])
+INDEX_EPOCH = datetime(1970, 1, 1)
+
+# Запись истории: дата записи, timestamp, транзакции и разобранные при чтении (дата, модуль суммы)
+# для каждой транзакции. Производные поля хранятся отдельно, словари транзакций остаются как в файле
+HistoryEntry = Tuple[datetime, str, List[Dict], List[Tuple[Optional[datetime], float]]]
+
 
 class TransactionHistory:
     """Класс для управления историей транзакций."""
     
     def __init__(self, history_file: str = "transaction_history.jsonl"):
         self.history_file = history_file
+        # Индекс записей: смещение строки в файле истории и время записи
+        self.index_file = history_file + ".idx"
+        # Разобранные записи истории и ключ (mtime, размер) файла, для которого они актуальны
+        self._entries_cache: List[HistoryEntry] = []
+        self._cache_key: Optional[Tuple[int, int]] = None
+        # Разобранный участок файла [начало, конец) в байтах и идут ли записи по возрастанию времени
+        self._cache_start: Optional[int] = None
+        self._cache_offset = 0
+        self._entries_sorted = True
+        # Таблица транзакций для векторной статистики и ключ кэша, для которого она построена
+        self._frame: Optional[pd.DataFrame] = None
+        self._frame_key: Optional[Tuple[int, int, int]] = None
+        # Индекс транзакций по контрагенту и версия данных, для которой он построен
+        self._by_counterparty: Optional[Dict[Any, List[Tuple[datetime, str, Dict]]]] = None
+        self._by_counterparty_key: Optional[Tuple[int, int, int]] = None
+        # Результаты аналитических запросов: ключ запроса -> (срок актуальности, результат)
+        self._results_cache: Dict[Tuple, Tuple[datetime, Any]] = {}
+        self._results_key: Optional[Tuple[int, int]] = None
+        # Открытые на дозапись файлы истории и индекса, еще не сброшенные строки и записи индекса
+        # к ним (смещение от начала буфера, время записи)
+        self._history_fh = None
+        self._index_fh = None
+        self._write_buffer = bytearray()
+        self._pending_index: List[Tuple[int, int]] = []
         self._ensure_history_file()
     
     def _ensure_history_file(self):
@@ -23,22 +81,77 @@ class TransactionHistory:
             with open(self.history_file, 'w', encoding='utf-8') as f:
                 pass  # Создаем пустой файл
     
-    def save_transactions(self, transactions: List[Dict], metadata: Dict = None):
+    def save_transactions(self, transactions: List[Dict], metadata: Dict = None, flush: bool = True):
         """
         Сохраняет транзакции в историю.
         
         Args:
             transactions: Список транзакций с полями: Дата, Сумма, Категория, Подкатегория, Контрагент
             metadata: Дополнительные метаданные (режим налогообложения, имя файла и т.д.)
+            flush: Сразу сбросить запись на диск; при массовом импорте можно передать False
+                и вызвать flush() в конце
         """
+        entry_date = datetime.now()
         entry = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": entry_date.isoformat(),
             "metadata": metadata or {},
             "transactions": transactions
         }
         
-        with open(self.history_file, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        if ORJSON_AVAILABLE:
+            # orjson не экранирует не-ASCII символы и умеет сериализовать скаляры NumPy
+            line = orjson.dumps(entry, option=orjson.OPT_SERIALIZE_NUMPY)
+        else:
+            line = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        
+        # Абсолютное смещение строки станет известно только при сбросе буфера в файл
+        self._pending_index.append((len(self._write_buffer), self._to_micros(entry_date)))
+        self._write_buffer += line + b'\n'
+        if flush or len(self._write_buffer) >= HISTORY_WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def _get_write_handles(self):
+        """Лениво открывает файлы истории и индекса на дозапись; дескрипторы держатся открытыми между вызовами."""
+        if self._history_fh is None:
+            self._history_fh = open(self.history_file, 'ab')
+            self._index_fh = open(self.index_file, 'ab')
+        return self._history_fh, self._index_fh
+
+    def flush(self) -> None:
+        """Сбрасывает накопленные записи на диск."""
+        if not self._write_buffer:
+            return
+        history_fh, index_fh = self._get_write_handles()
+        # Тот же файл может дописывать другой процесс (второй воркер, CLI), поэтому смещения
+        # берутся из размера файла под эксклюзивной блокировкой, а не из позиции своего дескриптора
+        if FCNTL_AVAILABLE:
+            fcntl.flock(history_fh.fileno(), fcntl.LOCK_EX)
+        try:
+            base_offset = os.fstat(history_fh.fileno()).st_size
+            history_fh.write(self._write_buffer)
+            history_fh.flush()
+            # Индекс сбрасывается после истории: отстающий индекс только заставляет
+            # разобрать чуть больше строк, но не теряет записи
+            index_fh.write(b''.join(
+                INDEX_RECORD.pack(base_offset + relative_offset, ts)
+                for relative_offset, ts in self._pending_index
+            ))
+            index_fh.flush()
+        finally:
+            if FCNTL_AVAILABLE:
+                fcntl.flock(history_fh.fileno(), fcntl.LOCK_UN)
+        self._write_buffer = bytearray()
+        self._pending_index = []
+
+    def close(self) -> None:
+        """Сбрасывает записи и закрывает файлы истории и индекса."""
+        self.flush()
+        if self._history_fh is None:
+            return
+        self._history_fh.close()
+        self._index_fh.close()
+        self._history_fh = None
+        self._index_fh = None
     
     def get_historical_transactions(self, days_back: int = 90) -> List[Dict]:
         """
@@ -48,38 +161,262 @@ class TransactionHistory:
             days_back: Количество дней назад для выборки
             
         Returns:
-            Список всех транзакций за период
+            Список всех транзакций за период с меткой записи _entry_timestamp. Словари транзакций
+            общие с кэшем истории и не должны изменяться вызывающим кодом.
         """
         cutoff_date = datetime.now() - timedelta(days=days_back)
         all_transactions = []
         
-        if not os.path.exists(self.history_file):
+        for entry_date, _, transactions, _ in self._entries_since(cutoff_date):
+            if entry_date >= cutoff_date:
+                all_transactions.extend(transactions)
+        
+        return all_transactions
+
+    def get_dated_transactions(self, days_back: int = 90) -> List[Tuple[datetime, Dict]]:
+        """
+        Получает транзакции за последние N дней вместе с уже разобранной датой транзакции.
+        Транзакции без корректной даты пропускаются.
+        
+        Returns:
+            Список пар (дата транзакции, транзакция); словари общие с кэшем истории
+            и не должны изменяться вызывающим кодом
+        """
+        return [
+            (tx_date, tx)
+            for tx, tx_date, _ in self._window_transactions(days_back)
+            if tx_date is not None
+        ]
+
+    def _window_transactions(self, days_back: int):
+        """
+        Перебирает транзакции записей за последние N дней: (транзакция, дата, модуль суммы).
+        Словари транзакций общие с кэшем истории.
+        """
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        for entry_date, _, transactions, derived in self._entries_since(cutoff_date):
+            if entry_date >= cutoff_date:
+                for tx, (tx_date, amount) in zip(transactions, derived):
+                    yield tx, tx_date, amount
+
+    def _entries_since(self, cutoff_date: datetime) -> List[HistoryEntry]:
+        """
+        Возвращает записи истории, начиная с первой не старше cutoff_date.
+        Записи дописываются в конец файла по времени, поэтому начало окна ищется с конца
+        списка с остановкой на первой более старой записи.
+        """
+        entries = self._load_entries(cutoff_date)
+        if not self._entries_sorted:
+            return entries
+        start = len(entries)
+        while start > 0 and entries[start - 1][0] >= cutoff_date:
+            start -= 1
+        return entries[start:]
+
+    @staticmethod
+    def _to_micros(value: datetime) -> int:
+        """Время записи в микросекундах от 1970-01-01 (без учета часового пояса) для индекса."""
+        return (value - INDEX_EPOCH) // timedelta(microseconds=1)
+
+    def _window_start_offset(self, cutoff_date: Optional[datetime], file_size: int) -> int:
+        """
+        Ищет по индексу смещение, с которого нужно разбирать файл, чтобы получить все записи
+        не старше cutoff_date. Без индекса или при его несоответствии файлу возвращает 0.
+        """
+        if cutoff_date is None or not os.path.exists(self.index_file):
+            return 0
+        index = np.fromfile(self.index_file, dtype=INDEX_DTYPE)
+        offsets, times = index["offset"], index["ts"]
+        # Индекс используется, только если он согласован с файлом и упорядочен по времени
+        if (
+            len(index) == 0
+            or offsets[-1] >= file_size
+            or np.any(np.diff(offsets.astype(np.int64)) <= 0)
+            or np.any(np.diff(times) < 0)
+        ):
+            return 0
+        # Начинаем с последней записи старше окна: записи, не попавшие в индекс, все равно будут прочитаны
+        position = int(np.searchsorted(times, self._to_micros(cutoff_date), side="left"))
+        if position == 0:
+            return 0
+        offset = int(offsets[position - 1])
+        if offset > 0:
+            # Смещение должно указывать на начало строки
+            with open(self.history_file, 'rb') as f:
+                f.seek(offset - 1)
+                if f.read(1) != b'\n':
+                    return 0
+        return offset
+
+    def _load_entries(self, cutoff_date: Optional[datetime] = None) -> List[HistoryEntry]:
+        """
+        Возвращает разобранные записи истории: (дата записи, timestamp, транзакции).
+        Файл перечитывается, только если изменились его mtime или размер; если файл
+        только вырос (история дописывается в конец), разбираются лишь новые строки.
+        С cutoff_date начало разбора ищется по индексу: более старые записи не читаются,
+        пока не понадобятся запросу с более широким окном.
+        """
+        # Записи, сохраненные без flush, должны быть видны при чтении
+        self.flush()
+        try:
+            stat = os.stat(self.history_file)
+        except FileNotFoundError:
             return []
         
-        with open(self.history_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                try:
-                    entry = json.loads(line)
-                    entry_date = datetime.fromisoformat(entry["timestamp"])
-                    
-                    if entry_date >= cutoff_date:
-                        # Добавляем метаданные к каждой транзакции
-                        for tx in entry.get("transactions", []):
-                            tx_copy = tx.copy()
-                            tx_copy["_entry_timestamp"] = entry["timestamp"]
-                            all_transactions.append(tx_copy)
-                except (json.JSONDecodeError, KeyError, ValueError) as e:
-                    print(f"[WARN] Ошибка при чтении записи истории: {e}")
-                    continue
+        cache_key = (stat.st_mtime_ns, stat.st_size)
+        if stat.st_size == 0:
+            # Пустая история: ни индекс, ни файл не читаем
+            if self._cache_key != cache_key:
+                self._entries_cache = []
+                self._cache_start = None
+                self._cache_offset = 0
+                self._entries_sorted = True
+                self._cache_key = cache_key
+            return self._entries_cache
+        if cache_key != self._cache_key and stat.st_size < self._cache_offset:
+            # Файл перезаписан или усечен — разбираем заново
+            self._entries_cache = []
+            self._cache_start = None
+            self._cache_offset = 0
+            self._entries_sorted = True
         
-        return all_transactions
+        # Первая разобранная запись старше окна — более ранние записи не нужны
+        covered = (
+            cutoff_date is not None and self._entries_sorted
+            and self._entries_cache and self._entries_cache[0][0] < cutoff_date
+        )
+        if self._cache_start != 0 and not covered:
+            # Без упорядоченности записей пропускать начало файла нельзя
+            window_start = self._window_start_offset(cutoff_date if self._entries_sorted else None, stat.st_size)
+            if self._cache_start is None:
+                self._cache_start = self._cache_offset = window_start
+            elif window_start < self._cache_start:
+                # Окно шире уже разобранного участка — дочитываем записи перед ним
+                older = self._read_entries(window_start, self._cache_start)
+                if older and self._entries_cache and older[-1][0] > self._entries_cache[0][0]:
+                    self._entries_sorted = False
+                self._entries_cache = older + self._entries_cache
+                self._cache_start = window_start
+        
+        if cache_key != self._cache_key:
+            newer = self._read_entries(self._cache_offset)
+            if newer and self._entries_cache and newer[0][0] < self._entries_cache[-1][0]:
+                self._entries_sorted = False
+            self._entries_cache.extend(newer)
+            self._cache_offset = stat.st_size
+            self._cache_key = cache_key
+        return self._entries_cache
+
+    def _read_entries(self, start: int, end: Optional[int] = None) -> List[HistoryEntry]:
+        """
+        Разбирает записи файла истории в диапазоне байт [start, end) (до конца файла, если end не задан).
+        Файл читается блоками байт, строки выделяются по переводу строки без текстового декодера.
+        """
+        entries = []
+        with open(self.history_file, 'rb') as f:
+            f.seek(start)
+            remaining = -1 if end is None else end - start
+            buffer = b''
+            while remaining != 0:
+                chunk = f.read(HISTORY_READ_CHUNK_SIZE if remaining < 0 else min(HISTORY_READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining > 0:
+                    remaining -= len(chunk)
+                buffer += chunk
+                # В буфере остается только незавершенная последняя строка
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    self._add_entry(line, entries)
+            self._add_entry(buffer, entries)
+        return entries
+
+    def _add_entry(self, line: bytes, entries: List[HistoryEntry]) -> None:
+        """Разбирает одну строку истории и добавляет запись в список entries."""
+        if not line.strip():
+            return
+        try:
+            entry = _json_loads(line)
+            timestamp = entry["timestamp"]
+            entry_date = datetime.fromisoformat(timestamp)
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, ValueError) as e:
+            print(f"[WARN] Ошибка при чтении записи истории: {e}")
+            return
+        transactions = entry.get("transactions", [])
+        # Метка записи добавляется к транзакции один раз при чтении, а не копированием при каждом
+        # запросе. Дата и модуль суммы разбираются здесь же, но хранятся рядом со списком транзакций,
+        # чтобы в отдаваемые наружу словари не попадали несериализуемые служебные поля
+        derived = []
+        for tx in transactions:
+            tx["_entry_timestamp"] = timestamp
+            try:
+                amount = abs(float(tx.get("Сумма", 0)))
+            except (TypeError, ValueError):
+                amount = 0.0
+            derived.append((self._parse_tx_date(tx.get("Дата")), amount))
+        if entries and entry_date < entries[-1][0]:
+            self._entries_sorted = False
+        entries.append((entry_date, timestamp, transactions, derived))
+
+    def _memoized(self, key: Tuple, days_back: int, compute: Callable[[], Any]) -> Any:
+        """
+        Возвращает копию результата аналитического запроса за последние days_back дней из кэша.
+        Кэш сбрасывается при изменении файла истории; отдельный результат устаревает, когда
+        самая старая запись его окна выходит за границу периода.
+        """
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        self._load_entries(cutoff_date)
+        if self._results_key != self._cache_key:
+            self._results_cache = {}
+            self._results_key = self._cache_key
+        
+        cached = self._results_cache.get(key)
+        if cached is not None and datetime.now() <= cached[0]:
+            return copy.deepcopy(cached[1])
+        
+        result = compute()
+        window_dates = [entry_date for entry_date, *_ in self._entries_since(cutoff_date) if entry_date >= cutoff_date]
+        expires_at = min(window_dates) + timedelta(days=days_back) if window_dates else datetime.max
+        self._results_cache[key] = (expires_at, result)
+        return copy.deepcopy(result)
+
+    @staticmethod
+    def _parse_tx_date(date_str) -> Optional[datetime]:
+        """Разбирает дату транзакции (YYYY-MM-DD, допускается время после 'T'); None, если даты нет."""
+        if not date_str or not isinstance(date_str, str):
+            return None
+        try:
+            return datetime.fromisoformat(date_str.split('T')[0])
+        except ValueError:
+            return None
     
     def get_counterparty_history(self, counterparty: str, days_back: int = 90) -> List[Dict]:
-        """Получает историю транзакций с конкретным контрагентом."""
-        all_transactions = self.get_historical_transactions(days_back)
-        return [tx for tx in all_transactions if tx.get("Контрагент") == counterparty]
+        """Получает историю транзакций с конкретным контрагентом (словари общие с кэшем истории)."""
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        return [
+            tx for entry_date, _, tx in self._counterparty_index(cutoff_date).get(counterparty, [])
+            if entry_date >= cutoff_date
+        ]
+
+    def _counterparty_index(self, cutoff_date: datetime) -> Dict[Any, List[Tuple[datetime, str, Dict]]]:
+        """
+        Индекс транзакций по контрагенту: контрагент -> [(дата записи, timestamp, транзакция)]
+        в порядке файла. Строится один раз на версию файла истории и разобранный участок.
+        """
+        entries = self._load_entries(cutoff_date)
+        version = self._parsed_version()
+        if self._by_counterparty is None or self._by_counterparty_key != version:
+            by_counterparty = defaultdict(list)
+            for entry_date, timestamp, transactions, _ in entries:
+                for tx in transactions:
+                    by_counterparty[tx.get("Контрагент")].append((entry_date, timestamp, tx))
+            self._by_counterparty = dict(by_counterparty)
+            self._by_counterparty_key = version
+        return self._by_counterparty
+
+    def _parsed_version(self) -> Optional[Tuple[int, int, int]]:
+        """Версия разобранных данных: (mtime, размер) файла и начало разобранного участка."""
+        return (*self._cache_key, self._cache_start) if self._cache_key else None
     
     def get_category_statistics(self, category: str, days_back: int = 90) -> Dict:
         """
@@ -88,56 +425,137 @@ class TransactionHistory:
         Returns:
             Dict с полями: count, total, mean, std, min, max, monthly_totals
         """
-        all_transactions = self.get_historical_transactions(days_back)
-        category_transactions = [
-            tx for tx in all_transactions 
-            if tx.get("Категория") == category
-        ]
+        return self.get_category_statistics_bulk([category], days_back)[category]
+
+    def get_category_statistics_bulk(self, categories: List[str], days_back: int = 90) -> Dict[str, Dict]:
+        """
+        Получает статистику сразу по нескольким категориям за одно чтение истории.
         
-        if not category_transactions:
-            return {
-                "count": 0,
-                "total": 0,
-                "mean": 0,
-                "std": 0,
-                "min": 0,
-                "max": 0,
-                "monthly_totals": {}
-            }
+        Returns:
+            Dict: категория -> статистика в формате get_category_statistics
+        """
+        return self._memoized(
+            ("category_statistics", tuple(categories), days_back), days_back,
+            lambda: self._compute_category_statistics(categories, days_back),
+        )
+
+    def _compute_category_statistics(self, categories: List[str], days_back: int) -> Dict[str, Dict]:
+        """Считает статистику по категориям за период без кэша результатов."""
+        window = self._category_window(categories, days_back)
+        stats = {category: self._empty_category_statistics() for category in categories}
+        if window.empty:
+            return stats
         
-        amounts = [abs(float(tx.get("Сумма", 0))) for tx in category_transactions]
+        # Агрегаты по кодам категорий считаются на массивах NumPy: суммы через np.bincount,
+        # стандартное отклонение (выборочное, n - 1) — по отклонениям от среднего своей категории
+        category_column = window["Категория"].cat
+        codes = category_column.codes.to_numpy()
+        amounts = window["amount"].to_numpy()
+        size = len(category_column.categories)
+        counts = np.bincount(codes, minlength=size)
+        totals = np.bincount(codes, weights=amounts, minlength=size)
+        means = np.divide(totals, counts, out=np.zeros(size), where=counts > 0)
+        squares = np.bincount(codes, weights=(amounts - means[codes]) ** 2, minlength=size)
+        stds = np.sqrt(np.divide(squares, counts - 1, out=np.zeros(size), where=counts > 1))
+        mins = np.full(size, np.inf)
+        np.minimum.at(mins, codes, amounts)
+        maxs = np.full(size, -np.inf)
+        np.maximum.at(maxs, codes, amounts)
         
-        # Группировка по месяцам
-        monthly_totals = defaultdict(float)
-        for tx in category_transactions:
-            try:
-                date_str = tx.get("Дата", "")
-                if isinstance(date_str, str):
-                    date = datetime.fromisoformat(date_str.split('T')[0])
-                    month_key = date.strftime("%Y-%m")
-                    monthly_totals[month_key] += abs(float(tx.get("Сумма", 0)))
-            except (ValueError, AttributeError):
-                continue
+        # Помесячные суммы — одним groupby по категории и целочисленному ключу месяца (YYYYMM),
+        # строка "YYYY-MM" формируется только для результата
+        dated = window[window["date"].notna()]
+        month_keys = dated["date"].dt.year * 100 + dated["date"].dt.month
+        monthly = dated.groupby(["Категория", month_keys], sort=False, observed=True)["amount"].sum()
+        monthly_by_category = defaultdict(dict)
+        for (category, month_key), total in zip(monthly.index.tolist(), monthly.tolist()):
+            monthly_by_category[category][f"{month_key // 100:04d}-{month_key % 100:02d}"] = total
         
+        for category, code in zip(categories, category_column.categories.get_indexer(categories).tolist()):
+            if code < 0 or counts[code] == 0:
+                continue
+            count = int(counts[code])
+            stats[category] = {
+                "count": count,
+                "total": float(totals[code]),
+                "mean": float(means[code]),
+                "std": float(stds[code]) if count > 1 else 0,
+                "min": float(mins[code]),
+                "max": float(maxs[code]),
+                "monthly_totals": monthly_by_category[category]
+            }
+        return stats
+
+    @staticmethod
+    def _empty_category_statistics() -> Dict:
+        """Статистика категории без транзакций за период."""
         return {
-            "count": len(category_transactions),
-            "total": sum(amounts),
-            "mean": sum(amounts) / len(amounts) if amounts else 0,
-            "std": pd.Series(amounts).std() if len(amounts) > 1 else 0,
-            "min": min(amounts) if amounts else 0,
-            "max": max(amounts) if amounts else 0,
-            "monthly_totals": dict(monthly_totals)
+            "count": 0,
+            "total": 0,
+            "mean": 0,
+            "std": 0,
+            "min": 0,
+            "max": 0,
+            "monthly_totals": {}
         }
+
+    def _history_frame(self, cutoff_date: datetime) -> pd.DataFrame:
+        """
+        Таблица транзакций истории для векторных расчетов: дата записи, категория,
+        модуль суммы и дата транзакции. Строится один раз на версию файла истории
+        и разобранный участок; записи старше cutoff_date в ней могут отсутствовать.
+        Колонки хранятся массивами NumPy, категория — pd.Categorical с целочисленными кодами.
+        """
+        entries = self._load_entries(cutoff_date)
+        frame_key = self._parsed_version()
+        if self._frame is None or self._frame_key != frame_key:
+            entry_dates, categories, amounts, dates = [], [], [], []
+            for entry_date, _, transactions, derived in entries:
+                for tx, (tx_date, amount) in zip(transactions, derived):
+                    entry_dates.append(entry_date)
+                    categories.append(tx.get("Категория"))
+                    amounts.append(amount)
+                    dates.append(tx_date)
+            self._frame = pd.DataFrame({
+                "entry_date": pd.to_datetime(pd.Series(entry_dates, dtype=object)),
+                "Категория": pd.Categorical(pd.Series(categories, dtype=object)),
+                "amount": np.array(amounts, dtype=np.float64),
+                "date": pd.to_datetime(pd.Series(dates, dtype=object)),
+            })
+            self._frame_key = frame_key
+        return self._frame
+
+    def _category_window(self, categories: List[str], days_back: int) -> pd.DataFrame:
+        """Транзакции запрошенных категорий из записей истории за последние N дней."""
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        frame = self._history_frame(cutoff_date)
+        # Фильтр по категориям сравнивает целочисленные коды, а не строки каждой транзакции
+        category_column = frame["Категория"].cat
+        requested_codes = category_column.categories.get_indexer(categories)
+        mask = (
+            (frame["entry_date"].to_numpy() >= np.datetime64(cutoff_date))
+            & np.isin(category_column.codes.to_numpy(), requested_codes[requested_codes >= 0])
+        )
+        return frame[mask]
     
     def get_known_counterparties(self, days_back: int = 90) -> set:
         """Возвращает множество известных контрагентов за период."""
-        all_transactions = self.get_historical_transactions(days_back)
-        counterparties = set()
-        for tx in all_transactions:
-            counterparty = tx.get("Контрагент", "")
-            if counterparty and counterparty != "—":
-                counterparties.add(counterparty)
-        return counterparties
+        return self._memoized(
+            ("known_counterparties", days_back), days_back,
+            lambda: self._compute_known_counterparties(days_back),
+        )
+
+    def _compute_known_counterparties(self, days_back: int) -> set:
+        """Собирает известных контрагентов за период без кэша результатов."""
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        # Контрагент известен, если хотя бы одна его транзакция попала в период;
+        # проверка идет с конца списка, где самые свежие записи
+        return {
+            counterparty
+            for counterparty, items in self._counterparty_index(cutoff_date).items()
+            if counterparty and counterparty != "—"
+            and any(entry_date >= cutoff_date for entry_date, _, _ in reversed(items))
+        }
     
     def get_seasonal_patterns(self, category: str, days_back: int = 365) -> Dict:
         """
@@ -146,34 +564,44 @@ class TransactionHistory:
         Returns:
             Dict с полями: monthly_avg (средние по месяцам), trend (тренд)
         """
-        all_transactions = self.get_historical_transactions(days_back)
-        category_transactions = [
-            tx for tx in all_transactions 
-            if tx.get("Категория") == category
-        ]
-        
-        # Группировка по месяцам
-        monthly_totals = defaultdict(list)
-        for tx in category_transactions:
-            try:
-                date_str = tx.get("Дата", "")
-                if isinstance(date_str, str):
-                    date = datetime.fromisoformat(date_str.split('T')[0])
-                    month_key = date.strftime("%m")  # Только месяц (01-12)
-                    monthly_totals[month_key].append(abs(float(tx.get("Сумма", 0))))
-            except (ValueError, AttributeError):
-                continue
+        return self.get_seasonal_patterns_bulk([category], days_back)[category]
+
+    def get_seasonal_patterns_bulk(self, categories: List[str], days_back: int = 365) -> Dict[str, Dict]:
+        """
+        Анализирует сезонные паттерны сразу для нескольких категорий за одно чтение истории.
         
-        # Средние по месяцам
-        monthly_avg = {
-            month: sum(amounts) / len(amounts) if amounts else 0
-            for month, amounts in monthly_totals.items()
+        Returns:
+            Dict: категория -> паттерны в формате get_seasonal_patterns
+        """
+        return self._memoized(
+            ("seasonal_patterns", tuple(categories), days_back), days_back,
+            lambda: self._compute_seasonal_patterns(categories, days_back),
+        )
+
+    def _compute_seasonal_patterns(self, categories: List[str], days_back: int) -> Dict[str, Dict]:
+        """Считает сезонные паттерны по категориям за период без кэша результатов."""
+        window = self._category_window(categories, days_back)
+        window = window[window["date"].notna()]
+        # Средние по месяцам (только месяц 01-12) для всех категорий одним groupby
+        monthly = window.groupby(["Категория", window["date"].dt.month], sort=False, observed=True)["amount"].mean()
+        monthly_avg_by_category = {category: {} for category in categories}
+        for (category, month), avg in zip(monthly.index.tolist(), monthly.tolist()):
+            monthly_avg_by_category[category][month] = avg
+        return {
+            category: self._seasonal_patterns(monthly_avg)
+            for category, monthly_avg in monthly_avg_by_category.items()
         }
-        
+
+    @staticmethod
+    def _seasonal_patterns(monthly_avg: Dict[int, float]) -> Dict:
+        """
+        Считает тренд по средним за месяцы одной категории. Месяцы приходят целыми числами (1-12),
+        в результате ключи — строки "01"-"12".
+        """
         # Простой тренд (линейная регрессия)
         if len(monthly_avg) >= 2:
-            months = sorted([int(m) for m in monthly_avg.keys()])
-            values = [monthly_avg[str(m).zfill(2)] for m in months]
+            months = sorted(monthly_avg)
+            values = [monthly_avg[m] for m in months]
             # Простой расчет тренда (рост/падение)
             if len(values) >= 2:
                 trend = (values[-1] - values[0]) / len(values) if len(values) > 1 else 0
@@ -183,7 +611,7 @@ class TransactionHistory:
             trend = 0
         
         return {
-            "monthly_avg": monthly_avg,
+            "monthly_avg": {f"{month:02d}": avg for month, avg in monthly_avg.items()},
             "trend": trend
         }
     
@@ -203,68 +631,47 @@ class TransactionHistory:
         previous_end = current_start - timedelta(days=1)
         previous_start = previous_end - timedelta(days=period_days - 1)
         
-        # Получаем транзакции из истории за оба периода
-        all_transactions = self.get_historical_transactions(days_back=365)
+        # Агрегаты периода накапливаются по мере обхода транзакций
+        def new_period():
+            return {"income": 0, "expenses": 0, "by_category": defaultdict(float), "transaction_count": 0}
         
-        # Используем переданные транзакции текущего периода или ищем в истории
-        if current_transactions_list:
-            current_transactions = current_transactions_list
-        else:
-            current_transactions = []
-            for tx in all_transactions:
-                try:
-                    date_str = tx.get("Дата", "")
-                    if not date_str:
-                        continue
-                        
-                    if isinstance(date_str, str):
-                        tx_date = datetime.fromisoformat(date_str.split('T')[0])
-                        
-                        if current_start <= tx_date <= current_end:
-                            current_transactions.append(tx)
-                except (ValueError, AttributeError):
-                    continue
-        
-        # Ищем предыдущий период в истории
-        previous_transactions = []
-        for tx in all_transactions:
-            try:
-                date_str = tx.get("Дата", "")
-                if not date_str:
-                    continue
-                    
-                if isinstance(date_str, str):
-                    tx_date = datetime.fromisoformat(date_str.split('T')[0])
-                    
-                    if previous_start <= tx_date <= previous_end:
-                        previous_transactions.append(tx)
-            except (ValueError, AttributeError):
-                continue
+        def add_transaction(period, tx, amount):
+            if tx.get("Категория") == "Поступление от клиента":
+                period["income"] += amount
+            else:
+                period["expenses"] += amount
+                # По категориям
+                period["by_category"][tx.get("Категория", "Прочее")] += amount
+            period["transaction_count"] += 1
         
-        # Агрегируем данные
-        def aggregate_period(transactions):
-            income = sum(abs(float(tx.get("Сумма", 0))) for tx in transactions 
-                       if tx.get("Категория") == "Поступление от клиента")
-            expenses = sum(abs(float(tx.get("Сумма", 0))) for tx in transactions 
-                          if tx.get("Категория") != "Поступление от клиента")
-            
-            # По категориям
-            by_category = defaultdict(float)
-            for tx in transactions:
-                if tx.get("Категория") != "Поступление от клиента":
-                    cat = tx.get("Категория", "Прочее")
-                    by_category[cat] += abs(float(tx.get("Сумма", 0)))
-            
+        def finish_period(period):
             return {
-                "income": income,
-                "expenses": expenses,
-                "balance": income - expenses,
-                "by_category": dict(by_category),
-                "transaction_count": len(transactions)
+                "income": period["income"],
+                "expenses": period["expenses"],
+                "balance": period["income"] - period["expenses"],
+                "by_category": dict(period["by_category"]),
+                "transaction_count": period["transaction_count"]
             }
         
-        current_data = aggregate_period(current_transactions)
-        previous_data = aggregate_period(previous_transactions)
+        current_data = new_period()
+        previous_data = new_period()
+        # Используем переданные транзакции текущего периода или ищем в истории
+        use_history_for_current = not current_transactions_list
+        if not use_history_for_current:
+            for tx in current_transactions_list:
+                add_transaction(current_data, tx, abs(float(tx.get("Сумма", 0))))
+        
+        # Один проход по истории за год раскладывает транзакции по текущему и предыдущему периодам
+        for tx, tx_date, amount in self._window_transactions(days_back=365):
+            if tx_date is None:
+                continue
+            if use_history_for_current and current_start <= tx_date <= current_end:
+                add_transaction(current_data, tx, amount)
+            elif previous_start <= tx_date <= previous_end:
+                add_transaction(previous_data, tx, amount)
+        
+        current_data = finish_period(current_data)
+        previous_data = finish_period(previous_data)
         
         # Сравнение
         comparison = {}